@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Compare extracting the versions from APKPure pages using BeautifulSoup against the targeted parser
+# Usage: python benchmarks/bench_apkpure_parse.py [saved versions pages...]
+# Without arguments, a synthetic page with the same structure as the real ones is used.
+# BeautifulSoup is no longer a dependency, the comparison is skipped if it's not installed.
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils.APKPure_dl import apkpure_versions  # noqa: E402
+
+
+# Generate a versions page, mostly unrelated markup with APK and XAPK download links
+def synthetic_page(n_versions=60) -> str:
+    filler = "".join(
+        f'<div class="card"><img src="/img/{i}.png" alt="item {i}">'
+        f'<p class="desc">Some description &amp; text number {i}</p></div>'
+        for i in range(1500)
+    )
+    script = "<script>var data = {" + ",".join(f'"k{i}": {i}' for i in range(5000)) + "};</script>"
+    links = []
+    for i in range(n_versions):
+        version = f"{20 - i // 20}.{i % 20}.{i % 7}"
+        for kind in ["APK", "XAPK"]:
+            links.append(
+                f'<li><a class="ver_download_link" href="/app/download/{version}" '
+                f'data-dt-app="com.example.app" data-dt-version="{version}" '
+                f'data-dt-versioncode="{2000000 - i * 10 + len(kind)}" '
+                f'data-dt-apkid="b/{kind}/com.example.app?versionCode={2000000 - i * 10}">'
+                f'<div class="ver-item"><span class="name">App {version}</span>'
+                f'<span class="size">{100 + i} MB</span></div></a></li>'
+            )
+    return (
+        f"<!DOCTYPE html><html><head><title>Versions</title>{script}</head><body>"
+        f'{filler}<ul class="ver-wrap">{"".join(links)}</ul>{filler}{script}</body></html>'
+    )
+
+
+# The extraction done by apkpure_dl before the targeted parser
+def soup_versions(html) -> dict[str, str]:
+    from bs4 import BeautifulSoup as bs
+
+    soup = bs(html, "html.parser")
+    versions = {}
+    for x in soup.css.select('a[data-dt-apkid^="b/APK/"]'):
+        versions.setdefault(x["data-dt-version"], x["data-dt-versioncode"])
+    return versions
+
+
+def peak_memory(func, html) -> int:
+    tracemalloc.start()
+    func(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    pages = {}
+    for path in sys.argv[1:]:
+        with open(path, "r") as f:
+            pages[os.path.basename(path)] = f.read()
+    if not pages:
+        pages["synthetic"] = synthetic_page()
+
+    try:
+        import bs4  # noqa: F401
+
+        have_soup = True
+    except ImportError:
+        have_soup = False
+        print("BeautifulSoup is not installed, only timing the targeted parser.")
+
+    rounds = 5
+    for name, html in pages.items():
+        versions = apkpure_versions(html)
+        print(f"{name}: {len(html) / 1024:.0f} KiB, {len(versions)} versions")
+        new = timeit.timeit(lambda: apkpure_versions(html), number=rounds) / rounds
+        peak = peak_memory(apkpure_versions, html) / 1024
+        print(f"  targeted parser: {new * 1000:8.2f} ms {peak:8.0f} KiB peak")
+
+        if have_soup:
+            assert soup_versions(html) == versions, "the parsers found different versions"
+            old = timeit.timeit(lambda: soup_versions(html), number=rounds) / rounds
+            peak = peak_memory(soup_versions, html) / 1024
+            print(f"  BeautifulSoup:   {old * 1000:8.2f} ms {peak:8.0f} KiB peak")
+            print(f"  speedup:         {old / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Check that the checkonly path stays within its startup and latency budgets
+# Exits with a non-zero code if any of the budgets is exceeded, so that it can be used in CI.
+# Usage: python benchmarks/bench_checkonly.py
+
+import contextlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import utils.Check as check  # noqa: E402
+from bench_e2e import Handler, Upstream  # noqa: E402
+
+# Extra time allowed for importing everything needed by checkonly, over a bare interpreter
+STARTUP_BUDGET = 0.15
+# The upstream queries run concurrently, so a check shouldn't take much longer than one of them
+LATENCY = 0.2
+LATENCY_BUDGET = 1.5 * LATENCY + 0.1
+HEAVY_MODULES = ["requests", "cloudscraper", "bs4", "utils.Pipeline", "utils.APKPure_dl"]
+
+
+def timed_python(code) -> float:
+    times = []
+    for _ in range(7):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=SRC)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main() -> None:
+    failed = False
+
+    # Startup, measured in fresh interpreters
+    imports = "import ReVancedBuilder, utils.Check"
+    loaded = subprocess.run(
+        [sys.executable, "-c", f"{imports}; import sys; print(' '.join(sys.modules))"],
+        check=True,
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    heavy = [m for m in HEAVY_MODULES if m in loaded]
+    if heavy:
+        print(f"FAIL: checkonly imports {', '.join(heavy)}")
+        failed = True
+
+    startup = timed_python(imports) - timed_python("pass")
+    status = "ok" if startup <= STARTUP_BUDGET else "FAIL"
+    print(
+        f"{status}: import overhead {startup * 1000:.0f} ms (budget {STARTUP_BUDGET * 1000:.0f} ms)"
+    )
+    failed |= startup > STARTUP_BUDGET
+
+    # Latency against a local server that mimics GitHub
+    Handler.upstream = Upstream(1, LATENCY)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    check.GITHUB_API = f"http://127.0.0.1:{server.server_address[1]}/api.github.com"
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for name in ["cold cache", "warm cache"]:
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    code = check.check()
+                latency = time.perf_counter() - start
+                ok = latency <= LATENCY_BUDGET and code == check.UPDATE_AVAILABLE
+                print(
+                    f"{'ok' if ok else 'FAIL'}: {name} check took {latency * 1000:.0f} ms, "
+                    f"exit code {code} (budget {LATENCY_BUDGET * 1000:.0f} ms)"
+                )
+                failed |= not ok
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
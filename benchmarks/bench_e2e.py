@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Offline end-to-end benchmark of a full ReVancedBuilder run
+# GitHub, api.revanced.app, APKPure and ntfy/Gotify are replaced by a local HTTP server,
+# and java by fake_java.py, so that it runs without network access or a JDK.
+# Usage: python benchmarks/bench_e2e.py [--help]
+
+import argparse
+import configparser as cp
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import ReVancedBuilder as rb  # noqa: E402
+import utils.Pipeline as pipeline  # noqa: E402
+
+PACKAGES = {
+    "com.google.android.youtube": ("youtube", ["19.16.39", "19.25.37", "19.34.42"]),
+    "com.google.android.apps.youtube.music": ("youtube-music", ["7.16.53", "7.25.53"]),
+}
+PHASES = ["update_tools", "get_apks", "update_signatures", "build_apps", "move_apps", "send_notif"]
+
+
+# Everything the fake upstream servers know about, mutable between scenarios
+class Upstream:
+    def __init__(self, apk_size, latency) -> None:
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+        self.notifications = 0
+        self.releases = {"revanced-cli": "5.0.0", "revanced-patches": "5.1.0", "GmsCore": "0.3.1"}
+        self.apks = {pkg: os.urandom(1024) * (apk_size * 1024) for pkg in PACKAGES}
+
+    def asset(self, item) -> bytes:
+        # Tools are small, but their content changes with the version
+        seed = f"{item}-{self.releases[item]}".encode("utf-8")
+        return hashlib.sha256(seed).digest() * 32768
+
+    def count(self, sent) -> None:
+        with self.lock:
+            self.bytes_sent += sent
+            self.requests += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    upstream: Upstream
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send(self, body, status=200, content_type="application/json", extra=None) -> None:
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.upstream.count(0)
+            return
+
+        # Serve ranges of files, like GitHub and the APKPure CDN
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        headers = dict(extra or {})
+        if match and content_type == "application/octet-stream":
+            start = int(match.group(1))
+            end = int(match.group(2) or len(body) - 1)
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            body = body[start : end + 1]
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(usegmt=True))
+        if content_type == "application/octet-stream":
+            self.send_header("Accept-Ranges", "bytes")
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.upstream.count(len(body))
+
+    def do_GET(self) -> None:
+        time.sleep(self.upstream.latency)
+        up = self.upstream
+        url = urlsplit(self.path)
+        host, _, path = url.path.lstrip("/").partition("/")
+        path = "/" + path
+
+        if host == "api.github.com" and path.endswith("/releases/latest"):
+            item = path.split("/")[3]
+            ext = {"revanced-cli": "jar", "revanced-patches": "rvp", "GmsCore": "apk"}[item]
+            ver = up.releases[item]
+            asset = f"https://github.com/revanced/{item}/releases/download/v{ver}/{item}.{ext}"
+            self.send(
+                {
+                    "tag_name": f"v{ver}",
+                    "assets": [
+                        {"browser_download_url": asset + ".asc"},
+                        {"browser_download_url": asset},
+                    ],
+                }
+            )
+        elif host == "api.github.com" and "/attestations/" in path:
+            self.send({"attestations": [{"bundle": {"mediaType": "fake"}}]})
+        elif host == "github.com":
+            self.send(up.asset(path.split("/")[2]), content_type="application/octet-stream")
+        elif host == "api.revanced.app" and path == "/v5/patches":
+            self.send({"signature_download_url": "https://api.revanced.app/v5/patches/asc"})
+        elif host == "api.revanced.app" and path == "/v5/patches/asc":
+            self.send(b"-----BEGIN PGP SIGNATURE-----", content_type="application/octet-stream")
+        elif host == "api.revanced.app" and path == "/v5/patches/keys":
+            self.send({"patches_public_key": "-----BEGIN PGP PUBLIC KEY BLOCK-----"})
+        elif host == "apkpure.com" and path.endswith("/versions"):
+            pkg = path.split("/")[2]
+            links = [
+                f'<a class="ver_download_link" data-dt-apkid="b/APK/{pkg}" '
+                f'data-dt-version="{v}" data-dt-versioncode="{1000 + i}" href="#">{v}</a>'
+                for i, v in enumerate(PACKAGES[pkg][1])
+            ]
+            # Real pages are mostly unrelated markup
+            filler = "<div class='ad'><span>filler</span></div>" * 2000
+            page = f"<html><body>{filler}<ul>{''.join(links)}</ul>{filler}</body></html>"
+            self.send(page, content_type="text/html")
+        elif host == "d.apkpure.com":
+            pkg = path.split("/")[3]
+            assert "versionCode" in parse_qs(url.query)
+            self.send(up.apks[pkg], content_type="application/octet-stream")
+        else:
+            self.send({"message": "Not Found"}, status=404)
+
+    def do_POST(self) -> None:
+        time.sleep(self.upstream.latency)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.upstream.lock:
+            self.upstream.notifications += 1
+        self.send({"ok": True})
+
+
+# Send every request made through requests (and cloudscraper) to the local server
+def redirect_requests(port) -> None:
+    original = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname not in ["127.0.0.1", "localhost"]:
+            query = f"?{parts.query}" if parts.query else ""
+            url = f"http://127.0.0.1:{port}/{parts.hostname}{parts.path}{query}"
+        return original(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request
+
+
+# Wrap the phases of main(), recording the time spent in each of them
+# Returns the original functions, so that they can be restored afterwards
+def instrument(timings) -> dict:
+    originals = {name: getattr(pipeline, name) for name in PHASES}
+    for name, func in originals.items():
+
+        def timed(*args, _func=func, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _func(*args, **kwargs)
+            finally:
+                timings[_name] = timings.get(_name, 0.0) + time.perf_counter() - start
+
+        setattr(pipeline, name, timed)
+    return originals
+
+
+def write_configs(workdir, policy) -> None:
+    build_config = cp.ConfigParser()
+    for pkg, (appname, _) in PACKAGES.items():
+        for root in [False, True]:
+            name = f"{appname}_{'root' if root else 'nonroot'}"
+            build_config[name] = {
+                "build": "true",
+                "pretty_name": appname + (" (root)" if root else ""),
+                "apk": pkg,
+                "apkpure_appname": appname,
+                "root": str(root).lower(),
+                "output_name": f"{appname}_ReVanced_{'root' if root else 'nonroot'}",
+            }
+    build_config["metrics"] = {"prometheus_textfile": "revanced_builder.prom"}
+    build_config["post_script"] = {"file": "true"}
+    build_config["patches_diff"] = {"policy": policy}
+    with open(os.path.join(workdir, "build_config"), "w") as f:
+        build_config.write(f)
+
+    notification_config = cp.ConfigParser()
+    notification_config["ntfy"] = {
+        "enabled": "true",
+        "url": "https://ntfy.sh",
+        "topic": "bench",
+        "token": "token",
+    }
+    notification_config["gotify"] = {
+        "enabled": "true",
+        "url": "https://gotify.example.com",
+        "token": "token",
+    }
+    with open(os.path.join(workdir, "notification_config"), "w") as f:
+        notification_config.write(f)
+
+
+def run(workdirs, flag=None, verbose=False) -> tuple[dict, float, int]:
+    timings = {}
+    originals = instrument(timings)
+
+    # main() sets up its own log file handler, keep everything else quiet
+    logging.getLogger().handlers = [logging.NullHandler()]
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    sys.argv = ["ReVancedBuilder"] + workdirs + ([flag] if flag else [])
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    code = 0
+    try:
+        with output:
+            rb.main()
+    except SystemExit as ex:
+        code = ex.code if isinstance(ex.code, int) else 1
+    finally:
+        total = time.perf_counter() - start
+        os.chdir(cwd)
+        for name, func in originals.items():
+            setattr(pipeline, name, func)
+    return timings, total, code
+
+
+def report(name, timings, total, code, upstream, sent_before) -> None:
+    sent = upstream.bytes_sent - sent_before
+    download_time = timings.get("update_tools", 0.0) + timings.get("get_apks", 0.0)
+    status = "ok" if code == 0 else f"exit code {code}"
+    print(f"{name} ({status}): {total:.2f}s total")
+    for phase in PHASES:
+        if phase in timings:
+            print(f"  {phase:<18} {timings[phase]:8.3f}s")
+    throughput = sent / download_time / 2**20 if download_time else 0.0
+    print(f"  {'downloaded':<18} {sent / 2**20:8.1f} MiB ({throughput:.1f} MiB/s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--apk-size", type=int, default=32, help="size of the APKs in MiB")
+    parser.add_argument("--latency", type=float, default=0.05, help="server latency in seconds")
+    parser.add_argument("--java-startup", type=float, default=0.3, help="fake JVM startup time")
+    parser.add_argument("--patch-delay", type=float, default=1.0, help="fake patching time")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the runs")
+    parser.add_argument(
+        "--patches-policy",
+        choices=["rebuild", "skip", "defer"],
+        default="rebuild",
+        help="what to do with apps that aren't affected by a new patches release",
+    )
+    parser.add_argument(
+        "--profiles", type=int, default=1, help="number of working directories built together"
+    )
+    args = parser.parse_args()
+
+    upstream = Upstream(args.apk_size, args.latency)
+    Handler.upstream = upstream
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    redirect_requests(server.server_address[1])
+
+    tmp = tempfile.mkdtemp(prefix="revanced-bench-")
+    bin_dir = os.path.join(tmp, "bin")
+    workdirs = [os.path.join(tmp, "work" + (str(i) if i else "")) for i in range(args.profiles)]
+    os.mkdir(bin_dir)
+    fake_java = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_java.py")
+    with open(os.path.join(bin_dir, "java"), "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{fake_java}" "$@"\n')
+    os.chmod(os.path.join(bin_dir, "java"), 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_JAVA_STARTUP"] = str(args.java_startup)
+    os.environ["FAKE_JAVA_PATCH_DELAY"] = str(args.patch_delay)
+    os.environ["FAKE_JAVA_PACKAGES"] = ";".join(
+        f"{pkg}={','.join(vers)}" for pkg, (_, vers) in PACKAGES.items()
+    )
+    for workdir in workdirs:
+        os.mkdir(workdir)
+        write_configs(workdir, args.patches_policy)
+
+    def patches_release() -> None:
+        upstream.releases["revanced-patches"] = "5.2.0"
+
+    # One of the builds fails, and the next run resumes from the checkpoint
+    def interrupted_release() -> None:
+        upstream.releases["revanced-patches"] = "5.3.0"
+        os.environ["FAKE_JAVA_FAIL"] = "music"
+
+    def resume() -> None:
+        del os.environ["FAKE_JAVA_FAIL"]
+
+    scenarios = [
+        ("cold run", None, None),
+        ("nothing to do", None, None),
+        ("new patches release", None, patches_release),
+        ("interrupted build", None, interrupted_release),
+        ("resumed run", None, resume),
+        ("forced rebuild", "force", None),
+    ]
+    try:
+        for name, flag, prepare in scenarios:
+            if prepare:
+                prepare()
+            sent_before = upstream.bytes_sent
+            timings, total, code = run(workdirs, flag, args.verbose)
+            report(name, timings, total, code, upstream, sent_before)
+        print(f"{upstream.requests} requests served, {upstream.notifications} notifications")
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Working directories kept at {', '.join(workdirs)}")
+        else:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Compare version selection with a linear scan over the parsed patches against the package index
+# Usage: python benchmarks/bench_version_index.py [patches] [packages] [versions]
+
+import os
+import sys
+import timeit
+
+from packaging.version import Version
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from utils.APKPure_dl import choose_version, index_patches, parse_patches  # noqa: E402
+
+
+# Generate list-patches output in the format printed by revanced-cli
+def synthetic_listing(n_patches, n_packages, n_versions) -> str:
+    blocks = []
+    for i in range(n_patches):
+        lines = [f"Name: Patch {i}", "Description: Synthetic patch", "Enabled: true"]
+        lines.append("Compatible packages:")
+        for p in range(i % 3 + 1):
+            pkg = (i + p) % n_packages
+            lines.append(f"\tPackage name: com.example.app{pkg}")
+            lines.append("\tCompatible versions:")
+            # Patches drop support for old versions at different points
+            for v in range(i % 5, n_versions):
+                lines.append(f"\t\t{19 + v // 10}.{v % 10}.{pkg}")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+# The selection loop used by get_apks before the index was introduced
+def linear_choose(patches, apk):
+    version_sets = []
+    for item in patches or []:
+        for pkg in item.get("compatible_packages") or []:
+            if not pkg:
+                continue
+            if pkg.get("package_name") != apk:
+                continue
+            versions = set(v for v in (pkg.get("compatible_versions") or []) if v is not None)
+            if versions:
+                version_sets.append(versions)
+
+    compatible_vers = set.intersection(*version_sets) if version_sets else set()
+    if not compatible_vers:
+        return Version("0")
+    required_ver = max(map(lambda x: Version(x), compatible_vers))
+    return next(filter(lambda x: Version(x) == required_ver, compatible_vers))
+
+
+def main() -> None:
+    args = [int(x) for x in sys.argv[1:4]]
+    n_patches, n_packages, n_versions = args + [2000, 20, 100][len(args) :]
+    patches = parse_patches(synthetic_listing(n_patches, n_packages, n_versions))
+    apps = [f"com.example.app{p}" for p in range(0, n_packages, 2)]
+
+    index = index_patches(patches)
+    for apk in apps:
+        assert str(linear_choose(patches, apk)) == (choose_version(index, apk) or "0")
+
+    rounds = 5
+    linear = timeit.timeit(lambda: [linear_choose(patches, apk) for apk in apps], number=rounds)
+    build = timeit.timeit(lambda: index_patches(patches), number=rounds)
+    lookup = timeit.timeit(lambda: [choose_version(index, apk) for apk in apps], number=rounds)
+
+    print(f"{n_patches} patches, {n_packages} packages, {n_versions} versions, {len(apps)} apps")
+    print(f"linear scan:   {linear / rounds * 1000:8.2f} ms")
+    print(f"index lookups: {lookup / rounds * 1000:8.2f} ms")
+    print(f"speedup:       {linear / lookup:8.2f}x")
+    # The index is cached along with the patches, so this is paid once per patches release
+    print(f"index build:   {build / rounds * 1000:8.2f} ms (once per patch bundle)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Stand-in for `java -jar revanced-cli.jar`, used by bench_e2e.py
+# Delays are read from FAKE_JAVA_STARTUP and FAKE_JAVA_PATCH_DELAY (in seconds),
+# the packages and versions to list from FAKE_JAVA_PACKAGES ("pkg=v1,v2;pkg2=v3").
+# Builds whose output name contains FAKE_JAVA_FAIL fail halfway through.
+
+import os
+import sys
+import time
+
+PATCH_STEPS = [
+    "Loading patches",
+    "Decoding app manifest",
+    "Merging integrations",
+    "Executing patches",
+    "Compiling modified resources",
+    "Aligning APK",
+    "Signing APK",
+]
+
+
+def listing(packages) -> str:
+    blocks = []
+    index = 0
+    for pkg, versions in packages.items():
+        for i in range(20):
+            lines = [
+                f"Index: {index}",
+                f"Name: Patch {index}",
+                "Description: A patch used for benchmarking.",
+                "Enabled: true",
+                "Compatible packages:",
+                f"\tPackage name: {pkg}",
+            ]
+            # Some patches support every version, others only some of them
+            if i % 4:
+                lines.append("\tCompatible versions:")
+                lines += [f"\t\t{v}" for v in versions[i % 2 :]]
+            blocks.append("\n".join(lines))
+            index += 1
+    return "\n\n".join(blocks) + "\n"
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    time.sleep(float(os.environ.get("FAKE_JAVA_STARTUP", "0")))
+
+    for arg in args:
+        if arg.startswith("-XX:ArchiveClassesAtExit="):
+            with open(arg.split("=", 1)[1], "wb") as f:
+                f.write(b"fake cds archive")
+
+    if "--version" in args:
+        print("ReVanced CLI v5.0.0")
+    elif "list-patches" in args:
+        packages = {}
+        for entry in os.environ.get("FAKE_JAVA_PACKAGES", "").split(";"):
+            if "=" in entry:
+                pkg, versions = entry.split("=", 1)
+                packages[pkg] = versions.split(",")
+        sys.stdout.write(listing(packages))
+    elif "patch" in args:
+        output = args[args.index("-o") + 1]
+        delay = float(os.environ.get("FAKE_JAVA_PATCH_DELAY", "0"))
+        fail = os.environ.get("FAKE_JAVA_FAIL")
+        for step in PATCH_STEPS:
+            print(f"INFO: {step}", flush=True)
+            time.sleep(delay / len(PATCH_STEPS))
+            if fail and fail in output and step == "Executing patches":
+                print('SEVERE: "Benchmark patch" failed:', flush=True)
+                print("java.lang.IllegalStateException: Fingerprint not found", flush=True)
+                sys.exit(1)
+        with open(args[-1], "rb") as src, open(output, "wb") as dst:
+            dst.write(src.read())
+        print(f"INFO: Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
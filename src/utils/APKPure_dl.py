@@ -2,56 +2,103 @@
 
 # SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
 # SPDX-License-Identifier: GPL-3.0-only
+import hashlib
+import json
 import os
 import re
+import time
+
+from html.parser import HTMLParser
 
 import cloudscraper as scraper
-from bs4 import BeautifulSoup as bs
-from packaging.version import Version
+from packaging.version import InvalidVersion, Version
 from subprocess import check_output
 
 
+from utils.ArtifactStore import fetch
+from utils.Checkpoint import write_json
 from utils.Cleanup import err_exit
+from utils.Downloader import file_hash
+from utils.HTTPCache import cached_get
+from utils.JVM import java_cmd, log_jvm_time
 
-# Determine the best version available to download
+PATCHES_CACHE = "patches-cache.json"
 
+APK_ID_PREFIX = "b/APK/"
 
-def apkpure_best_match(version, soup, appstate, apk) -> str:
-    try:
-        vers_list_str = [
-            x["data-dt-version"] for x in soup.css.select('a[data-dt-apkid^="b/APK/"]')
-        ]
-    except Exception as ex:
-        err_exit(f"    There was some error getting list of versions of {apk}: {ex}", appstate)
 
-    vers_list = map(lambda x: Version(x), vers_list_str)
+# Collects the version codes from the download links, without building the whole document tree
+class VersionListParser(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.versions = {}
+
+    def handle_starttag(self, tag, attrs) -> None:
+        if tag != "a":
+            return
+        attrs = dict(attrs)
+        if not (attrs.get("data-dt-apkid") or "").startswith(APK_ID_PREFIX):
+            return
+        version = attrs.get("data-dt-version")
+        # The first link for a version wins, same as on the page
+        if version and version not in self.versions:
+            self.versions[version] = attrs.get("data-dt-versioncode")
+
 
-    if version != "0":
-        vers_list = filter(lambda x: x <= Version(version), vers_list)
+# Get a map from version to versionCode of the apks listed on a versions page
+def apkpure_versions(html) -> dict[str, str]:
+    # Everything outside the download links is irrelevant, so only that part is parsed
+    first = html.find("data-dt-apkid")
+    if first == -1:
+        return {}
+    last = html.rfind("data-dt-apkid")
+    start = html.rfind("<", 0, first)
+    end = html.find(">", last)
 
-    max_ver = max(vers_list)
-    return next(filter(lambda x: Version(x) == max_ver, vers_list_str))
+    parser = VersionListParser()
+    parser.feed(html[start : end + 1 if end != -1 else len(html)])
+    parser.close()
+    return parser.versions
+
+
+# Determine the best version available to download
+def apkpure_best_match(version, versions, appstate, apk) -> str:
+    try:
+        vers_list = {x: Version(x) for x in versions}
+
+        if version != "0":
+            max_allowed = Version(version)
+            vers_list = {k: v for k, v in vers_list.items() if v <= max_allowed}
+
+        return max(vers_list, key=vers_list.__getitem__)
+    except Exception as ex:
+        err_exit(f"    There was some error getting list of versions of {apk}: {ex}", appstate)
 
 
 # Download an apk from apkpure.net
+# Returns the version, which is the latest one on APKPure if it's "0"
 
 
-def apkpure_dl(apk, appname, version, hard_version, session, present_vers, flag, appstate) -> None:
+def apkpure_dl(apk, appname, version, hard_version, session, present_vers, flag, appstate) -> str:
+    # Pages are kept for the rest of the run, in case the same package is needed again
+    pages = appstate["apkpure_pages"]
+    url = f"https://apkpure.com/{appname}/{apk}/versions"
     try:
-        res = session.get(f"https://apkpure.com/{appname}/{apk}/versions")
-        soup = bs(res.text, "html.parser")
+        if url not in pages:
+            pages[url] = apkpure_versions(cached_get(url, session))
+        versions = pages[url]
     except Exception as ex:
         err_exit(f"Could not get list of available versions from APKPure.: {ex}", appstate, 1)
 
     try:
         if present_vers[apk] == version and flag != "force" and os.path.isfile(apk + ".apk"):
             print(f"Recommended version {version} of {apk} is already present.")
-            return
+            return version
     except KeyError:
         pass
 
     if not hard_version:
-        apkpure_version = apkpure_best_match(version, soup, appstate, apk)
+        apkpure_version = apkpure_best_match(version, versions, appstate, apk)
         if version not in [apkpure_version, "0"]:
             print(
                 f"Required version {version} for {apk} not found in APKPure.\n",
@@ -61,33 +108,36 @@ def apkpure_dl(apk, appname, version, hard_version, session, present_vers, flag,
                 "Also update the versions.json file before retrying.",
             )
             err_exit(f"Could not download the required version for {apk}.", appstate)
+        version = apkpure_version
         try:
             if present_vers[apk] == version and flag != "force" and os.path.isfile(apk + ".apk"):
                 print(f"Recommended version {version} of {apk} is already present.")
-                return
+                return version
         except KeyError:
             pass
 
     if flag == "checkonly" and present_vers[apk] != version:
         print(f"{apk} has an update ({present_vers[apk]} -> {version})")
-        return
+        return version
 
     print(f"  Downloading {apk} version {version}...")
 
     # Get the version code
+    ver_code = versions.get(version)
+    if not ver_code:
+        err_exit(f"    Could not find the versionCode of {apk} version {version}.", appstate)
+
     try:
-        ver_code = soup.css.select(f'a[data-dt-version="{version}"][data-dt-apkid^="b/APK/"]')[0][
-            "data-dt-versioncode"
-        ]
+        fetch(
+            f"https://d.apkpure.com/b/APK/{apk}?versionCode={ver_code}",
+            apk + ".apk",
+            appstate,
+            session,
+        )
     except Exception as ex:
         err_exit(f"    There was some error while downloading {apk}: {ex}", appstate)
-
-    res = session.get(f"https://d.apkpure.com/b/APK/{apk}?versionCode={ver_code}", stream=True)
-    res.raise_for_status()
-    with open(apk + ".apk", "wb") as f:
-        for chunk in res.iter_content(chunk_size=8192):
-            f.write(chunk)
     print("    Done!")
+    return version
 
 
 # Parse patches output to JSON
@@ -95,8 +145,9 @@ def parse_patches(data) -> list[dict]:
     res = []
 
     for block in re.split(r"\n\s*\n", data.strip()):
-        d: dict[str, str | list[dict] | None] = {
+        d: dict[str, str | bool | list[dict] | None] = {
             "name": None,
+            "enabled": None,
             "compatible_packages": [],
         }
 
@@ -108,6 +159,9 @@ def parse_patches(data) -> list[dict]:
             if s.startswith("Name:"):
                 d["name"] = s.split(":", 1)[1].strip()
 
+            elif s.startswith("Enabled:"):
+                d["enabled"] = s.split(":", 1)[1].strip() == "true"
+
             elif s.startswith("Package name:"):
                 if pkg:
                     d["compatible_packages"].append(pkg)
@@ -135,36 +189,194 @@ def parse_patches(data) -> list[dict]:
     return res
 
 
-# Download apk files, if needed
-def get_apks(appstate) -> dict:
-    present_vers = appstate["present_vers"]
-    build_config = appstate["build_config"]
-    flag = appstate["flag"]
+# Index the parsed patches by package name, for quick version selection
+# For every package, it has all the versions sorted from oldest to newest,
+# and the compatible versions of each patch that supports specific versions
+# Versions that can't be compared are left out, and listed separately
+def index_patches(patches) -> dict[str, dict]:
+    index = {}
+    invalid = {}
+    parsed = {}
+    for item in patches or []:
+        for pkg in item.get("compatible_packages") or []:
+            versions = []
+            for v in (pkg or {}).get("compatible_versions") or []:
+                if v is None:
+                    continue
+                if v not in parsed:
+                    try:
+                        parsed[v] = Version(v)
+                    except InvalidVersion:
+                        parsed[v] = None
+                if parsed[v] is None:
+                    invalid.setdefault(pkg["package_name"], set()).add(v)
+                else:
+                    versions.append(v)
+            if versions:
+                index.setdefault(pkg["package_name"], []).append(versions)
+
+    for apk, patch_versions in index.items():
+        all_versions = set().union(*patch_versions)
+        index[apk] = {
+            "versions": sorted(all_versions, key=parsed.__getitem__),
+            "patch_versions": patch_versions,
+            "invalid": sorted(invalid.get(apk, [])),
+        }
+    return index
 
-    print("Downloading required apk files from APKPure...")
 
-    # Create a cloudscraper session
-    session = scraper.create_scraper()
+# Latest version of a package that's compatible with all of its patches
+# Returns None if none of the patches need a specific version
+def choose_version(index, apk) -> str | None:
+    try:
+        entry = index[apk]
+    except KeyError:
+        return None
+
+    first, *rest = entry["patch_versions"]
+    compatible_vers = set(first).intersection(*rest)
+
+    # The versions are already sorted, so the first match from the end is the latest one
+    for v in reversed(entry["versions"]):
+        if v in compatible_vers:
+            return v
+    return None
+
+
+# Summary of the patches that apply to a package, for finding out whether a release affects it
+# Maps the name of every patch to a hash of whether it's enabled and its compatible versions
+def patch_set(patches, apk) -> dict[str, str]:
+    res = {}
+    for item in patches:
+        pkgs = item.get("compatible_packages")
+        if pkgs is None:
+            # Universal patches apply to every package
+            versions = None
+        else:
+            matches = [pkg for pkg in pkgs if pkg["package_name"] == apk]
+            if not matches:
+                continue
+            versions = matches[0]["compatible_versions"]
+        data = res.get(item["name"], "") + json.dumps([item.get("enabled"), versions])
+        res[item["name"]] = hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+    return res
+
+
+# Describe the differences between two patch sets, empty if there are none
+def diff_patch_sets(old, new) -> str:
+    changes = {
+        "added": sorted(new.keys() - old.keys()),
+        "removed": sorted(old.keys() - new.keys()),
+        "changed": sorted(k for k in new.keys() & old.keys() if new[k] != old[k]),
+    }
+    res = []
+    for what, names in changes.items():
+        if names:
+            more = f" and {len(names) - 3} more" if len(names) > 3 else ""
+            res.append(f"{what} {', '.join(names[:3])}{more}")
+    return "; ".join(res)
+
+
+# Check that the cached patch list looks like something parse_patches produced
+def valid_patches(patches) -> bool:
+    if not isinstance(patches, list):
+        return False
+    for item in patches:
+        if not isinstance(item, dict) or "name" not in item:
+            return False
+        pkgs = item.get("compatible_packages")
+        if pkgs is None:
+            continue
+        if not isinstance(pkgs, list):
+            return False
+        for pkg in pkgs:
+            if not isinstance(pkg, dict) or "package_name" not in pkg:
+                return False
+            if not isinstance(pkg.get("compatible_versions"), (list, type(None))):
+                return False
+    return True
+
+
+# Get the parsed list of patches and its index by package,
+# from the cache if the patches and cli haven't changed
+def list_patches(appstate) -> tuple[list[dict], dict[str, dict]]:
+    print = appstate["logger"].info
 
-    # Get latest patches from the patches file
     try:
+        bundle_hash = file_hash("revanced-patches.rvp")
+    except OSError as ex:
+        err_exit(f"Error fetching patches, {ex}", appstate)
+    key = f"{bundle_hash}-{appstate['present_vers'].get('revanced-cli', '0')}"
+
+    # Another profile has already listed the same patches in this invocation
+    shared = appstate.get("shared", {}).setdefault("patches", {})
+    if key in shared:
+        print("Using the list of patches of the previous profile.")
+        patches, index = shared[key]
+        write_patches_cache(key, patches, index)
+        return patches, index
+
+    try:
+        with open(PATCHES_CACHE, "r") as f:
+            cache = json.load(f)
+        if (
+            cache["key"] == key
+            and valid_patches(cache["patches"])
+            and isinstance(cache.get("index"), dict)
+            and all("invalid" in entry for entry in cache["index"].values())
+        ):
+            print("Using cached list of patches.")
+            shared[key] = cache["patches"], cache["index"]
+            return cache["patches"], cache["index"]
+        print("Cached list of patches is outdated, rebuilding it.")
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError, TypeError):
+        print("Cached list of patches is corrupted, rebuilding it.")
+
+    try:
+        start = time.perf_counter()
         raw_patches = check_output(
-            [
-                "java",
-                "-jar",
-                "revanced-cli.jar",
-                "list-patches",
-                "-bp",
-                "revanced-patches.rvp",
-                "--packages",
-                "--versions",
-            ],
+            java_cmd()
+            + ["list-patches", "-bp", "revanced-patches.rvp", "--packages", "--versions"],
             text=True,
         )
+        log_jvm_time(appstate, "Listing patches", time.perf_counter() - start)
         patches = parse_patches(raw_patches)
+        index = index_patches(patches)
     except Exception as ex:
         err_exit(f"Error fetching patches, {ex}", appstate)
 
+    write_patches_cache(key, patches, index)
+    shared[key] = patches, index
+    return patches, index
+
+
+def write_patches_cache(key, patches, index) -> None:
+    write_json(PATCHES_CACHE, {"key": key, "patches": patches, "index": index})
+
+
+# Download apk files, if needed
+def get_apks(appstate) -> dict:
+    present_vers = appstate["present_vers"]
+    build_config = appstate["build_config"]
+    flag = appstate["flag"]
+
+    print("Downloading required apk files from APKPure...")
+
+    # Create a cloudscraper session, or reuse the one from the previous run in daemon mode
+    # (or from the previous profile, along with the APKPure pages, in multi-profile mode)
+    shared = appstate.get("shared", {})
+    if "scraper" not in shared:
+        shared["scraper"] = appstate.get("scraper") or scraper.create_scraper()
+    session = appstate["scraper"] = shared["scraper"]
+
+    # Get latest patches from the patches file
+    patches, index = list_patches(appstate)
+    appstate["apkpure_pages"] = shared.setdefault("apkpure_pages", {})
+
+    # Sections for the same package (e.g. root and nonroot) share the scraping and download
+    groups = {}
     for app in build_config:
         # Check if we need to build an app
         if not build_config[app].getboolean("build"):
@@ -177,41 +389,31 @@ def get_apks(appstate) -> dict:
         except Exception as ex:
             err_exit(f"Invalid config for {app} in build_config!: {ex}", appstate)
 
-        print(f"Checking {pretty_name}...")
-        try:
-            required_ver = build_config[app]["version"]
+        key = (apk, apkpure_appname, build_config[app].get("version"))
+        groups.setdefault(key, {})[app] = pretty_name
+
+    for (apk, apkpure_appname, hard_ver), apps in groups.items():
+        print(f"Checking {', '.join(apps.values())}...")
+        if hard_ver is not None:
+            required_ver = hard_ver
             hard_version = True
             # print(f"Using version {required_ver} of {apk} from build_config.")
-        except KeyError:
+        else:
             print("Trying to choose version.")
             hard_version = False
-            version_sets = []
-            for item in patches or []:
-                for pkg in item.get("compatible_packages") or []:
-                    if not pkg:
-                        continue
-                    if pkg.get("package_name") != apk:
-                        continue
-                    versions = set(
-                        v for v in (pkg.get("compatible_versions") or []) if v is not None
-                    )
-                    if versions:  # only keep non-empty sets
-                        version_sets.append(versions)
-
-            compatible_vers = set.intersection(*version_sets) if version_sets else set()
-
-            if not compatible_vers:
-                required_ver = Version("0")
+            required_ver = choose_version(index, apk)
+            for v in index.get(apk, {}).get("invalid", []):
+                print(f"Ignoring version {v} of {apk} from the patches, it isn't a valid version.")
+            if required_ver is None:
+                print(f"No specific version of {apk} is required, using the latest one.")
+                required_ver = "0"
             else:
-                required_ver = max(map(lambda x: Version(x), compatible_vers))
-                required_ver = next(filter(lambda x: Version(x) == required_ver, compatible_vers))
-
-            print(f"Chosen required version of {apk} is {required_ver}.")
+                print(f"Chosen required version of {apk} is {required_ver}.")
 
         if apk in appstate["present_vers"] and appstate["present_vers"][apk] == required_ver:
             print("It's already present on disk, so skipping download.")
         else:
-            apkpure_dl(
+            required_ver = apkpure_dl(
                 apk,
                 apkpure_appname,
                 required_ver,
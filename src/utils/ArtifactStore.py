@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import requests as req
+
+from utils.Checkpoint import write_json
+from utils.Downloader import (
+    MANIFEST,
+    chunk_size,
+    download,
+    file_hash,
+    hash_file,
+    record_hash,
+    segment_count,
+)
+from utils.Metrics import span
+
+# ioctl for cloning a file on filesystems like btrfs and XFS
+FICLONE = 0x40049409
+
+
+# Path of the shared artifact store, if one is configured
+def store_path(appstate) -> str | None:
+    try:
+        path = appstate["build_config"].get("downloads", "store", fallback=None)
+    except KeyError:
+        path = None
+    return os.path.expanduser(path) if path else None
+
+
+@contextmanager
+def locked(lock_file):
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_index(store) -> dict:
+    try:
+        with open(os.path.join(store, "index.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_index(store, index) -> None:
+    write_json(os.path.join(store, "index.json"), index, indent=4)
+
+
+def blob_path(store, digest) -> str:
+    return os.path.join(store, "sha256", digest[:2], digest)
+
+
+# Check that a blob still has the content it was stored with
+# Writing through one of its hardlinks changes its mtime, so it's only hashed again then
+def intact(store, digest) -> bool:
+    try:
+        return file_hash(blob_path(store, digest), os.path.join(store, MANIFEST)) == digest
+    except OSError:
+        return False
+
+
+# Same check for a file shared by an earlier profile, from the size and mtime it was shared with
+def unchanged(path, digest, size, mtime) -> bool:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size == size and stat.st_mtime_ns == mtime:
+        return True
+    return hash_file(path).hexdigest() == digest
+
+
+# Put a file from the store in the working directory, without copying the data if possible
+def link_blob(blob, output_file) -> None:
+    if os.path.isfile(output_file) and os.path.samefile(blob, output_file):
+        return
+
+    tmp_file = output_file + ".link"
+    try:
+        os.remove(tmp_file)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(blob, tmp_file)
+    except OSError:
+        try:
+            with open(blob, "rb") as src, open(tmp_file, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfile(blob, tmp_file)
+    os.replace(tmp_file, output_file)
+
+
+# Download a file through the shared store, if one is configured
+# Returns the sha256 of the file
+def fetch(url, output_file, appstate, session=req) -> str:
+    with span(appstate, "download", file=output_file) as fields:
+        start = time.perf_counter()
+        digest, downloaded = fetch_file(url, output_file, appstate, session)
+        seconds = time.perf_counter() - start
+        fields["bytes"] = os.path.getsize(output_file)
+        fields["downloaded"] = downloaded
+        if downloaded and seconds:
+            fields["bytes_per_sec"] = fields["bytes"] / seconds
+    return digest
+
+
+# Returns the sha256 of the file and whether it had to be downloaded
+def fetch_file(url, output_file, appstate, session) -> tuple[str, bool]:
+    # In multi-profile mode, files are only downloaded for the first profile that needs them
+    shared = appstate.get("shared", {}).setdefault("files", {})
+    if url in shared and unchanged(*shared[url]):
+        path, digest, _, _ = shared[url]
+        appstate["logger"].info(f"Using {output_file} from {os.path.dirname(path)}.")
+        link_blob(path, output_file)
+        record_hash(output_file, digest)
+        return digest, False
+
+    digest, downloaded = fetch_stored(url, output_file, appstate, session)
+    stat = os.stat(output_file)
+    shared[url] = (os.path.abspath(output_file), digest, stat.st_size, stat.st_mtime_ns)
+    return digest, downloaded
+
+
+def fetch_stored(url, output_file, appstate, session) -> tuple[str, bool]:
+    store = store_path(appstate)
+    if not store:
+        digest = download(
+            url, output_file, session, chunk_size(appstate), segments=segment_count(appstate)
+        )
+        return digest, True
+
+    os.makedirs(os.path.join(store, "locks"), exist_ok=True)
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    # Builders in other directories wait here while one of them downloads the same url
+    with locked(os.path.join(store, "locks", url_hash + ".lock")):
+        # The index lock also covers the manifest of the blobs
+        with locked(os.path.join(store, "index.lock")):
+            digest = read_index(store).get(url)
+            reusable = digest and intact(store, digest)
+        if reusable:
+            appstate["logger"].info(f"Using {output_file} from the artifact store.")
+            link_blob(blob_path(store, digest), output_file)
+            record_hash(output_file, digest)
+            return digest, False
+        if digest and os.path.isfile(blob_path(store, digest)):
+            appstate["logger"].info(f"The stored {output_file} was modified, downloading it again.")
+            os.remove(blob_path(store, digest))
+
+        digest = download(
+            url, output_file, session, chunk_size(appstate), segments=segment_count(appstate)
+        )
+
+        blob = blob_path(store, digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if not os.path.isfile(blob):
+            try:
+                os.remove(blob + ".tmp")
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(output_file, blob + ".tmp")
+            except OSError:
+                shutil.copyfile(output_file, blob + ".tmp")
+            os.replace(blob + ".tmp", blob)
+            with locked(os.path.join(store, "index.lock")):
+                record_hash(blob, digest, os.path.join(store, MANIFEST))
+        link_blob(blob, output_file)
+        record_hash(output_file, digest)
+
+        with locked(os.path.join(store, "index.lock")):
+            index = read_index(store)
+            index[url] = digest
+            write_index(store, index)
+
+    return digest, True
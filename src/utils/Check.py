@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# The checkonly path, which only finds out whether there are new releases of the tools
+# It's run very frequently, so it only uses the standard library and packaging,
+# and doesn't take the lock since it doesn't change anything in the working directory
+# except the HTTP cache.
+
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from packaging.version import Version
+
+from utils.Checkpoint import pending_build
+from utils.HTTPCache import conditional_headers, load_entry, store_entry
+
+GITHUB_API = "https://api.github.com"
+# The tools and the files they're downloaded to
+TOOLS = {
+    "revanced-cli": "revanced-cli.jar",
+    "revanced-patches": "revanced-patches.rvp",
+    "GmsCore": "GmsCore.apk",
+}
+TIMEOUT = 10
+
+# Exit codes, following the conventions of monitoring plugins
+UP_TO_DATE = 0
+UPDATE_AVAILABLE = 1
+UNKNOWN = 3
+
+
+def latest_version(item) -> str:
+    url = f"{GITHUB_API}/repos/revanced/{item}/releases/latest"
+    entry = load_entry(url)
+    headers = conditional_headers(entry)
+    if "GITHUB_TOKEN" in os.environ:
+        headers["Authorization"] = f"Bearer {os.environ['GITHUB_TOKEN']}"
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as res:
+            body = res.read().decode("utf-8")
+        store_entry(url, res.headers.get("ETag"), res.headers.get("Last-Modified"), body)
+    except urllib.error.HTTPError as ex:
+        if ex.code != 304 or not entry:
+            raise
+        body = entry["body"]
+    return json.loads(body)["tag_name"]
+
+
+# Print a JSON summary of the available updates, and return the exit code
+def check() -> int:
+    start = time.perf_counter()
+    try:
+        with open("versions.json", "r") as f:
+            present_vers = json.load(f)
+    except (OSError, ValueError):
+        present_vers = {}
+
+    with ThreadPoolExecutor(max_workers=len(TOOLS)) as pool:
+        futures = {item: pool.submit(latest_version, item) for item in TOOLS}
+
+    summary = {"status": "up-to-date", "pending_build": pending_build(present_vers)}
+    summary["tools"] = {}
+    code = UPDATE_AVAILABLE if summary["pending_build"] else UP_TO_DATE
+    for item, future in futures.items():
+        present = present_vers.get(item, "0")
+        try:
+            latest = str(Version(future.result()))
+            # A missing file is downloaded again by the next run, like an update
+            update = Version(present) < Version(latest) or not os.path.isfile(TOOLS[item])
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            summary["tools"][item] = {"present": present, "error": str(ex)}
+            code = UNKNOWN
+            continue
+        summary["tools"][item] = {"present": present, "latest": latest, "update": update}
+        if update and code == UP_TO_DATE:
+            code = UPDATE_AVAILABLE
+
+    summary["status"] = {
+        UP_TO_DATE: "up-to-date",
+        UPDATE_AVAILABLE: "update-available",
+        UNKNOWN: "error",
+    }[code]
+    summary["elapsed"] = round(time.perf_counter() - start, 3)
+    print(json.dumps(summary, indent=4))
+    return code
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Keeps track of the completed stages of a run, so that an interrupted run can be resumed
+# The stages are apks, signatures, build, archive, post_script and notify, and every
+# finished build is also recorded on its own.
+
+import hashlib
+import json
+import os
+
+CHECKPOINT = "checkpoint.json"
+# Number of runs that try a failing post command before giving up on it
+POST_SCRIPT_ATTEMPTS = 3
+
+
+# Write a JSON file so that it's never left half written, even if the machine crashes
+def write_json(path, data, **kwargs) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+# Hash of the build config, a checkpoint is only valid as long as it stays the same
+def config_hash() -> str | None:
+    try:
+        with open("build_config", "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+# Whether the last run left a build to be done, either in versions.json or in a checkpoint
+def pending_build(present_vers) -> bool:
+    return bool(present_vers.get("need_to_build", False)) or os.path.isfile(CHECKPOINT)
+
+
+# Load the checkpoint of an interrupted run, if it's still valid
+def load_checkpoint(appstate) -> dict:
+    print = appstate["logger"].info
+    checkpoint = {"config": config_hash(), "done": [], "built": {}}
+    try:
+        with open(CHECKPOINT, "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+
+    if not saved or not saved.get("done"):
+        pass
+    elif appstate["flag"] in ["force", "buildonly"]:
+        print("Discarding the checkpoint of the interrupted run.")
+    elif saved.get("config") != checkpoint["config"]:
+        print("The build config changed since the interrupted run, starting over.")
+    else:
+        print(f"Resuming the interrupted run, already done: {', '.join(saved['done'])}.")
+        checkpoint = saved
+
+    appstate["checkpoint"] = checkpoint
+    return checkpoint
+
+
+# Discard the checkpoint if the tools changed since the interrupted run, and record them
+def check_tools(appstate, tools) -> dict:
+    checkpoint = appstate["checkpoint"]
+    if checkpoint["done"] and checkpoint.get("tools") != tools:
+        appstate["logger"].info("The tools changed since the interrupted run, starting over.")
+        checkpoint = {"config": checkpoint["config"], "done": [], "built": {}}
+        appstate["checkpoint"] = checkpoint
+    checkpoint["tools"] = tools
+    return checkpoint
+
+
+# Whether a stage still has to be run
+def pending(appstate, stage) -> bool:
+    if stage in appstate["checkpoint"]["done"]:
+        appstate["logger"].info(f"Skipping {stage}, it was done by the interrupted run.")
+        return False
+    return True
+
+
+# Mark a stage as done
+def complete(appstate, stage) -> None:
+    checkpoint = appstate["checkpoint"]
+    if stage not in checkpoint["done"]:
+        checkpoint["done"].append(stage)
+        write_json(CHECKPOINT, checkpoint, indent=4)
+
+
+# Count a failed run of the post command, returns whether it should be tried again
+def failed_post_script(appstate) -> bool:
+    checkpoint = appstate["checkpoint"]
+    checkpoint["post_script_failures"] = checkpoint.get("post_script_failures", 0) + 1
+    write_json(CHECKPOINT, checkpoint, indent=4)
+    return checkpoint["post_script_failures"] < POST_SCRIPT_ATTEMPTS
+
+
+# Record a finished build, along with what's needed to archive it
+def complete_build(appstate, app, fingerprint, patch_set) -> None:
+    checkpoint = appstate["checkpoint"]
+    checkpoint["built"][app] = {"fingerprint": fingerprint, "patch_set": patch_set}
+    write_json(CHECKPOINT, checkpoint, indent=4)
+
+
+# The run finished, so there's nothing to resume
+def clear_checkpoint(appstate) -> None:
+    appstate["checkpoint"] = {"config": None, "done": [], "built": {}}
+    try:
+        os.remove(CHECKPOINT)
+    except FileNotFoundError:
+        pass
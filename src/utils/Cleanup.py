@@ -3,54 +3,186 @@
 # SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
 # SPDX-License-Identifier: GPL-3.0-only
 
+import gzip
+import json
 import os
+import re
+import shutil
 import sys
 import time
 
+from utils.Checkpoint import write_json
+from utils.Downloader import hash_file
+from utils.Metrics import export_prometheus
 from utils.Notifications import send_notif
 
+FINGERPRINTS = "fingerprints.json"
+PATCH_SETS = "patch-sets.json"
+ARCHIVE_MANIFEST = "archive.json"
+# Name of the files in the archive, before there was a manifest
+ARCHIVED_FILE = re.compile(r"^(.+)_(\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}Z)\.apk$")
+
 # Move apps to proper location
 
 
 def move_apps(appstate) -> None:
     build_config = appstate["build_config"]
-    print = appstate["logger"].info
 
     try:
         os.mkdir("archive")
     except FileExistsError:
         pass
 
+    built_apps = appstate.get("built_apps", {})
+    try:
+        with open(FINGERPRINTS, "r") as f:
+            fingerprints = json.load(f)
+    except (OSError, ValueError):
+        fingerprints = {}
+    try:
+        with open(PATCH_SETS, "r") as f:
+            patch_sets = json.load(f)
+    except (OSError, ValueError):
+        patch_sets = {}
+    builds = read_manifest()
+
     for app in build_config:
-        if not build_config[app].getboolean("build"):
+        if not build_config[app].getboolean("build") or app not in built_apps:
             continue
         name = build_config[app]["output_name"]
         final_name = f"{name}_{appstate['timestamp']}.apk"
 
         try:
             os.rename(name + ".apk", "archive/" + final_name)
+            if built_apps[app]:
+                fingerprints[app] = built_apps[app]
+            if app in appstate.get("patch_sets", {}):
+                patch_sets[app] = appstate["patch_sets"][app] | {"time": time.time()}
         except FileNotFoundError:
             pass
             # sys.exit('There was an error moving the final apk files!')
 
-        # Do some cleanup, keep only the last 3 build's worth of files and a week worth of logs
-        with os.scandir("archive") as dir:
-            files = []
-            for f in dir:
-                if name in f.name:
-                    files.append(f)
-            files.sort(key=lambda f: f.stat().st_ctime)
-            files.reverse()
-            for f in files[3:]:
-                os.remove(f)
-                print("Deleted old build " + f.name)
-
-        # Delete logs older than 7 days
-        with os.scandir("logs") as dir:
-            now = time.time()
-            for f in dir:
-                if f.stat().st_ctime < now - 7 * 86400:
-                    os.remove(f)
+        try:
+            size = os.path.getsize("archive/" + final_name)
+            sha256 = hash_file("archive/" + final_name).hexdigest()
+        except FileNotFoundError:
+            continue
+        builds = [x for x in builds if x["file"] != final_name]
+        builds.append(
+            {
+                "name": name,
+                "file": final_name,
+                "timestamp": time.time(),
+                "size": size,
+                "sha256": sha256,
+            }
+        )
+
+    builds = apply_retention(appstate, builds)
+    write_manifest(builds)
+
+    write_json(FINGERPRINTS, fingerprints, indent=4)
+    write_json(PATCH_SETS, patch_sets)
+
+
+# Read the list of archived builds, creating it from the contents of the archive if needed
+def read_manifest() -> list[dict]:
+    try:
+        with open(ARCHIVE_MANIFEST, "r") as f:
+            return json.load(f)["builds"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    builds = []
+    with os.scandir("archive") as dir:
+        for f in dir:
+            match = ARCHIVED_FILE.match(f.name)
+            if not match or not f.is_file():
+                continue
+            builds.append(
+                {
+                    "name": match.group(1),
+                    "file": f.name,
+                    "timestamp": f.stat().st_mtime,
+                    "size": f.stat().st_size,
+                    "sha256": hash_file(f.path).hexdigest(),
+                }
+            )
+    return builds
+
+
+def write_manifest(builds) -> None:
+    builds = sorted(builds, key=lambda x: x["timestamp"])
+    write_json(ARCHIVE_MANIFEST, {"builds": builds}, indent=4)
+
+
+# Delete old builds, by number per output name, age and total size of the archive
+# The latest build of every app is always kept, returns the builds that are left
+def apply_retention(appstate, builds) -> list[dict]:
+    print = appstate["logger"].info
+    build_config = appstate["build_config"]
+    keep = build_config.getint("archive", "keep", fallback=3)
+    max_age = build_config.getfloat("archive", "max_age_days", fallback=0) * 86400
+    max_size = build_config.getfloat("archive", "max_size_mb", fallback=0) * 1024 * 1024
+
+    # Newest first, builds that disappeared from the archive are forgotten
+    builds = sorted(builds, key=lambda x: x["timestamp"], reverse=True)
+    builds = [x for x in builds if os.path.isfile("archive/" + x["file"])]
+
+    count = {}
+    kept, expired = [], []
+    now = time.time()
+    for build in builds:
+        count[build["name"]] = count.get(build["name"], 0) + 1
+        latest = count[build["name"]] == 1
+        too_many = count[build["name"]] > keep
+        too_old = max_age and build["timestamp"] < now - max_age
+        (expired if not latest and (too_many or too_old) else kept).append(build)
+
+    if max_size:
+        total = sum(x["size"] for x in kept)
+        latest = {}
+        for build in kept:
+            latest.setdefault(build["name"], build)
+        for build in reversed(kept.copy()):
+            if total <= max_size:
+                break
+            if latest[build["name"]] is not build:
+                kept.remove(build)
+                expired.append(build)
+                total -= build["size"]
+
+    for build in expired:
+        try:
+            os.remove("archive/" + build["file"])
+        except FileNotFoundError:
+            pass
+        print("Deleted old build " + build["file"])
+    return kept
+
+
+# Compress the logs of previous runs, and delete the ones older than a week
+def cleanup_logs(appstate) -> None:
+    build_config = appstate["build_config"]
+    compress_after = build_config.getfloat("logs", "compress_after_days", fallback=1) * 86400
+    max_age = build_config.getfloat("logs", "max_age_days", fallback=7) * 86400
+
+    now = time.time()
+    with os.scandir("logs") as dir:
+        for f in dir:
+            # The logs of the current run are still being written
+            if f.name.startswith(appstate["timestamp"]) or not f.is_file():
+                continue
+            mtime = f.stat().st_mtime
+            if mtime < now - max_age:
+                os.remove(f.path)
+            elif mtime < now - compress_after and f.name.endswith((".log", ".jsonl")):
+                with open(f.path, "rb") as src, gzip.open(f.path + ".gz.tmp", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                # Keep the original time, so that the age is still counted from the run
+                os.utime(f.path + ".gz.tmp", (mtime, mtime))
+                os.replace(f.path + ".gz.tmp", f.path + ".gz")
+                os.remove(f.path)
 
 
 def err_exit(msg, appstate, code=1) -> None:
@@ -66,6 +198,8 @@ def err_exit(msg, appstate, code=1) -> None:
     except KeyError:
         pass
 
+    export_prometheus(appstate, code == 0)
+
     # Delete the lockfile
     os.remove("lockfile")
     sys.exit(code)
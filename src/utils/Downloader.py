@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests as req
+
+from utils.Checkpoint import write_json
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+RETRIES = 3
+# Connect and read timeout in seconds, so that a stalled connection gets retried
+TIMEOUT = 60
+# Smaller files aren't worth splitting into segments
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+MANIFEST = "hashes.json"
+# Suffix of the file next to a partial download, recording where it came from
+PART_INFO = ".json"
+
+manifest_lock = threading.Lock()
+
+
+class DownloadError(req.RequestException):
+    pass
+
+
+# Size of the buffer used for downloads, in KiB in build_config
+def chunk_size(appstate) -> int:
+    try:
+        size = appstate["build_config"].getint("downloads", "chunk_size", fallback=None)
+    except (KeyError, ValueError):
+        size = None
+    return size * 1024 if size else DEFAULT_CHUNK_SIZE
+
+
+# Number of parallel connections for a single download, from build_config
+def segment_count(appstate) -> int:
+    try:
+        count = appstate["build_config"].getint("downloads", "segments", fallback=1)
+    except (KeyError, ValueError):
+        count = 1
+    return max(count, 1)
+
+
+# Download a file to a temporary file, resuming partial downloads, and rename it when complete
+# Returns the sha256 of the file, which is also recorded in the manifest
+def download(
+    url, output_file, session=req, chunk_size=DEFAULT_CHUNK_SIZE, sha256=None, segments=1
+) -> str:
+    part_file = output_file + ".part"
+
+    # A partial download from an earlier attempt is resumed instead of starting over
+    if segments > 1 and not resumable_part(url, part_file)[0]:
+        try:
+            digest = fetch_segmented(url, part_file, session, chunk_size, segments)
+        except req.RequestException:
+            # Some mirrors don't cope with several connections, a single one may still work
+            digest = None
+        if digest:
+            return finish(part_file, output_file, digest, sha256)
+
+    for attempt in range(RETRIES):
+        try:
+            digest = fetch(url, part_file, session, chunk_size)
+            break
+        except (req.ConnectionError, req.Timeout, req.exceptions.ChunkedEncodingError) as e:
+            # Keep the partial file, so that the next attempt can resume it
+            if attempt == RETRIES - 1:
+                raise DownloadError(f"Download of {url} failed after {RETRIES} attempts, {e}")
+
+    return finish(part_file, output_file, digest, sha256)
+
+
+def finish(part_file, output_file, digest, sha256) -> str:
+    try:
+        os.remove(part_file + PART_INFO)
+    except FileNotFoundError:
+        pass
+    if sha256 and digest != sha256.lower():
+        os.remove(part_file)
+        raise DownloadError(f"Checksum mismatch for {output_file}")
+
+    os.replace(part_file, output_file)
+    record_hash(output_file, digest)
+    return digest
+
+
+# Fetch a file over several connections, each one getting a byte range of it
+# Returns None if the server doesn't support ranges, so that a single stream can be used
+def fetch_segmented(url, part_file, session, chunk_size, segments) -> str | None:
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT) as res:
+        res.raise_for_status()
+        # Use the final url, so that redirects aren't followed once per segment
+        url = res.url
+        try:
+            size = int(res.headers["Content-Range"].rsplit("/", 1)[1])
+        except (KeyError, ValueError, IndexError):
+            size = None
+        if (
+            res.status_code != 206
+            or res.headers.get("Accept-Ranges") != "bytes"
+            or size is None
+            or size < MIN_SEGMENT_SIZE
+        ):
+            return None
+
+    step = -(-size // segments)
+    ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    # Preallocate the file, so that every segment can be written in place
+    # It can't be resumed by fetch, since it has holes until it's complete
+    try:
+        os.remove(part_file + PART_INFO)
+    except FileNotFoundError:
+        pass
+    with open(part_file, "wb") as f:
+        f.truncate(size)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        futures = [
+            pool.submit(fetch_range, url, part_file, session, chunk_size, start, end)
+            for start, end in ranges
+        ]
+        for future in futures:
+            future.result()
+
+    # The segments arrive out of order, so the file has to be hashed once it's complete
+    return hash_file(part_file, chunk_size).hexdigest()
+
+
+# Fetch the bytes from start to end (inclusive) of a file into the same place in part_file
+def fetch_range(url, part_file, session, chunk_size, start, end) -> None:
+    offset = start
+    for attempt in range(RETRIES):
+        try:
+            headers = {"Range": f"bytes={offset}-{end}"}
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as res:
+                res.raise_for_status()
+                if res.status_code != 206 or range_start(res) != offset:
+                    raise DownloadError(f"Server ignored the range request for {url}")
+                with open(part_file, "r+b") as f:
+                    f.seek(offset)
+                    for chunk in res.iter_content(chunk_size=chunk_size):
+                        f.write(chunk[: end + 1 - offset])
+                        offset += len(chunk)
+                        # Anything past the end belongs to the next segment
+                        if offset > end:
+                            break
+            if offset > end:
+                return
+            raise req.ConnectionError(f"Got {offset - start} bytes out of {end + 1 - start}")
+        except (req.ConnectionError, req.Timeout, req.exceptions.ChunkedEncodingError) as e:
+            # Retry only the part of the range that's still missing
+            if attempt == RETRIES - 1:
+                raise DownloadError(f"Download of {url} failed after {RETRIES} attempts, {e}")
+
+
+# Fetch (the rest of) a file into part_file, verifying its size
+# The sha256 is computed while the bytes arrive
+def fetch(url, part_file, session, chunk_size) -> str:
+    offset, info = resumable_part(url, part_file)
+    validator = info.get("etag") or info.get("last_modified")
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as res:
+        if res.status_code == 416 or (res.status_code == 206 and range_start(res) != offset):
+            # Probably a leftover from a different version of the file, so start over
+            os.remove(part_file)
+            return fetch(url, part_file, session, chunk_size)
+        res.raise_for_status()
+
+        if res.status_code != 206:
+            offset = 0
+            etag = res.headers.get("ETag")
+            info = {
+                "url": url,
+                # Weak ETags can't be used for If-Range
+                "etag": etag if etag and not etag.startswith("W/") else None,
+                "last_modified": res.headers.get("Last-Modified"),
+            }
+            write_json(part_file + PART_INFO, info)
+        try:
+            expected = offset + int(res.headers["Content-Length"])
+        except (KeyError, ValueError):
+            expected = None
+        # Content-Length is the transferred size, so it's meaningless for compressed responses
+        if res.headers.get("Content-Encoding", "identity") != "identity":
+            expected = None
+
+        digest = hashlib.sha256()
+        if offset:
+            # The part we already have needs to be hashed once
+            hash_file(part_file, chunk_size, digest)
+
+        with open(part_file, "ab" if offset else "wb") as f:
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                digest.update(chunk)
+
+    size = os.path.getsize(part_file)
+    if expected is not None and size != expected:
+        raise req.ConnectionError(f"Got {size} bytes out of {expected} for {url}")
+
+    return digest.hexdigest()
+
+
+# Size and origin of a partial download that can be resumed, or (0, {}) if there's none
+# Only a partial file of the same url is resumed, and only if the server can tell whether
+# the file is still the same one
+def resumable_part(url, part_file) -> tuple[int, dict]:
+    try:
+        offset = os.path.getsize(part_file)
+        with open(part_file + PART_INFO, "r") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return 0, {}
+    if info.get("url") != url or not (info.get("etag") or info.get("last_modified")):
+        return 0, {}
+    return offset, info
+
+
+# First byte of a partial response, from its Content-Range
+def range_start(res) -> int | None:
+    try:
+        return int(res.headers["Content-Range"].split()[1].split("-")[0])
+    except (KeyError, ValueError, IndexError):
+        return None
+
+
+def hash_file(file, chunk_size=DEFAULT_CHUNK_SIZE, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest
+
+
+def read_manifest(manifest=MANIFEST) -> dict:
+    try:
+        with open(manifest, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_hash(file, digest, manifest=MANIFEST) -> None:
+    stat = os.stat(file)
+    with manifest_lock:
+        entries = read_manifest(manifest)
+        entries[file] = {"sha256": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        write_json(manifest, entries, indent=4)
+
+
+# Get the sha256 of a file from the manifest, only hashing it if the file has changed since
+def file_hash(file, manifest=MANIFEST) -> str:
+    stat = os.stat(file)
+    with manifest_lock:
+        entry = read_manifest(manifest).get(file)
+    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = hash_file(file).hexdigest()
+    record_hash(file, digest, manifest)
+    return digest
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+# This module is also used by the checkonly path, so it must not import requests
+
+import hashlib
+import json
+import os
+
+from utils.Checkpoint import write_json
+
+CACHE_DIR = "http-cache"
+
+
+def cache_path(url) -> str:
+    return os.path.join(CACHE_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+
+def load_entry(url) -> dict | None:
+    try:
+        with open(cache_path(url), "r") as f:
+            entry = json.load(f)
+        return entry if entry["url"] == url else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# Headers for making the request conditional on the cached copy changing
+def conditional_headers(entry) -> dict:
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def store_entry(url, etag, last_modified, body) -> None:
+    if not (etag or last_modified):
+        return
+    path = cache_path(url)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = {"url": url, "etag": etag, "last_modified": last_modified, "body": body}
+    write_json(path, entry)
+
+
+# GET a url using a requests session, making the request conditional if we have a cached copy
+# Returns the body of the response as text
+def cached_get(url, session, **kwargs) -> str:
+    entry = load_entry(url)
+    headers = dict(kwargs.pop("headers", None) or {})
+    headers.update(conditional_headers(entry))
+
+    res = session.get(url, headers=headers, **kwargs)
+    if res.status_code == 304 and entry:
+        return entry["body"]
+    res.raise_for_status()
+
+    store_entry(url, res.headers.get("ETag"), res.headers.get("Last-Modified"), res.text)
+    return res.text
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Idle connections kept open per host
+POOL_SIZE = 16
+TIMEOUT = 60
+RETRIES = 3
+# Stop this many requests short of the rate limit, so that it's never actually hit
+RATE_LIMIT_RESERVE = 1
+
+
+class RateLimitError(req.RequestException):
+    pass
+
+
+# Pools the connections, retries failed requests, and keeps track of the GitHub rate limit
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, appstate, **kwargs) -> None:
+        self.appstate = appstate
+        self.limits = {}
+        self.limits_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def add_headers(self, request, **kwargs) -> None:
+        token = github_token(self.appstate)
+        if token and urlsplit(request.url).hostname == "api.github.com":
+            request.headers["Authorization"] = f"Bearer {token}"
+
+    def send(self, request, **kwargs) -> req.Response:
+        host = urlsplit(request.url).netloc
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = TIMEOUT
+
+        self.wait_for_limit(host)
+        res = super().send(request, **kwargs)
+        self.update_limit(host, res)
+
+        # We ran into the limit anyway, e.g. because of another client using the same token
+        if res.status_code in [403, 429] and res.headers.get("X-RateLimit-Remaining") == "0":
+            res.close()
+            self.wait_for_limit(host)
+            res = super().send(request, **kwargs)
+            self.update_limit(host, res)
+        return res
+
+    def update_limit(self, host, res) -> None:
+        try:
+            remaining = int(res.headers["X-RateLimit-Remaining"])
+            reset = int(res.headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        with self.limits_lock:
+            self.limits[host] = (remaining, reset)
+
+    # Sleep until the rate limit is reset, if there are (almost) no requests left
+    def wait_for_limit(self, host) -> None:
+        with self.limits_lock:
+            remaining, reset = self.limits.get(host, (None, 0))
+        wait = reset - time.time() + 1
+        if remaining is None or remaining > RATE_LIMIT_RESERVE or wait <= 0:
+            return
+
+        config = self.appstate.get("build_config")
+        max_wait = config.getint("github", "max_wait", fallback=3600) if config else 3600
+        reset_time = time.strftime("%H:%M:%S", time.localtime(reset))
+        if wait > max_wait:
+            raise RateLimitError(f"Rate limit of {host} exhausted, it resets at {reset_time}")
+
+        self.appstate["logger"].info(
+            f"Rate limit of {host} almost exhausted, waiting until {reset_time}..."
+        )
+        # The daemon has to be able to stop while waiting
+        stop = self.appstate.get("stop")
+        if stop is None:
+            time.sleep(wait)
+        elif stop.wait(wait):
+            raise RateLimitError(f"Stopped while waiting for the rate limit of {host}")
+        with self.limits_lock:
+            if self.limits.get(host, (None, 0))[1] == reset:
+                del self.limits[host]
+
+
+def github_token(appstate) -> str | None:
+    config = appstate.get("build_config")
+    token = config.get("github", "token", fallback=None) if config else None
+    return token or os.environ.get("GITHUB_TOKEN")
+
+
+# Create the client shared by everything that talks to GitHub and the ReVanced API
+def new_session(appstate) -> req.Session:
+    # Failed downloads are resumed by the downloader itself, this only covers failed requests
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "HEAD"],
+        raise_on_status=False,
+    )
+    adapter = PooledAdapter(
+        appstate, pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+    )
+
+    session = req.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
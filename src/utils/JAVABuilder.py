@@ -4,11 +4,28 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import configparser as cp
+import hashlib
 import json
 import os
 import subprocess
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.Cleanup import err_exit
+from utils.APKPure_dl import diff_patch_sets, list_patches, patch_set
+from utils.Checkpoint import complete_build
+from utils.Cleanup import FINGERPRINTS, PATCH_SETS, err_exit
+from utils.Downloader import file_hash
+from utils.JVM import java_cmd, log_jvm_time
+
+# Lines of the build output that are also shown in the main log
+SUMMARY_LINE = re.compile(r"^(SEVERE|WARNING)|failed|Saved to")
+# Number of lines of the output kept for the error notification, and their maximum length
+TAIL_LINES = 20
+TAIL_LINE_LENGTH = 200
+# Total length of the output included in the error message, shared by all the failed builds
+TAIL_MAX_LENGTH = 2000
 
 # Build the revanced apps
 
@@ -30,65 +47,282 @@ def build_apps(appstate) -> None:
     except (KeyError, ValueError):
         excluded_patches = []
 
+    # Only rebuild the apps whose inputs changed since their last build
+    try:
+        with open(FINGERPRINTS, "r") as f:
+            fingerprints = json.load(f)
+    except (OSError, ValueError):
+        fingerprints = {}
+
+    # The patches that apply to every app at its last build, to see what a new release changes
+    try:
+        with open(PATCH_SETS, "r") as f:
+            patch_sets = json.load(f)
+    except (OSError, ValueError):
+        patch_sets = {}
+    patches = None
+    appstate["patch_sets"] = {}
+    # The fingerprints are saved by move_apps, once the builds are archived
+    appstate["built_apps"] = {}
+    resumed = appstate.get("checkpoint", {}).get("built", {})
+
+    builds = []
     for app in build_config:
         # Check if we need to build an app
         if not build_config[app].getboolean("build"):
             continue
+        pretty_name = build_config[app].get("pretty_name", app)
+        fp = fingerprint(app, build_config, included_patches, excluded_patches, flag)
+        if flag not in ["force", "buildonly"] and fp and fingerprints.get(app) == fp:
+            print(f"Nothing changed for {pretty_name}, skipping it.")
+            continue
+        # Built by the interrupted run, and still waiting to be archived
+        output_name = build_config[app].get("output_name", app)
+        if (
+            fp
+            and resumed.get(app, {}).get("fingerprint") == fp
+            and os.path.isfile(output_name + ".apk")
+        ):
+            print(f"{pretty_name} was already built by the interrupted run, skipping it.")
+            appstate["built_apps"][app] = fp
+            if resumed[app].get("patch_set"):
+                appstate["patch_sets"][app] = resumed[app]["patch_set"]
+            continue
+
+        # The patches don't decide anything here, so there's no need to list them
+        if flag in ["force", "buildonly"]:
+            print(f"Building {pretty_name}, since the {flag} flag was used.")
+            builds.append(app)
+            continue
+
+        if patches is None:
+            patches, _ = list_patches(appstate)
+        record = {
+            "inputs": fingerprint(
+                app, build_config, included_patches, excluded_patches, flag, with_patches=False
+            ),
+            "patches": patch_set(patches, build_config[app].get("apk")),
+        }
+        appstate["patch_sets"][app] = record
+        build, reason = patch_impact(appstate, app, record, patch_sets.get(app))
+        print(f"{'Building' if build else 'Not building'} {pretty_name}, {reason}.")
+        if not build:
+            continue
+
+        builds.append(app)
+
+    jobs, heap = parallel_limits(build_config, len(builds))
+    if jobs > 1:
+        print(f"Building {len(builds)} apps with {jobs} parallel jobs and {heap} MiB heap each.")
+    builds = [
+        (app,)
+        + build_command(app, build_config, included_patches, excluded_patches, flag, appstate, heap)
+        for app in builds
+    ]
+
+    # The output of every build goes to its own log file, only the summary is shown here
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for app, cmd, pretty_name, output_name in builds:
+            log_file = f"logs/{appstate['timestamp']}_{output_name}.log"
+            print(f"Building {pretty_name} using '{cmd}', output goes to {log_file}")
+            future = pool.submit(run_build, cmd, log_file, output_name, pretty_name, print)
+            futures.append((app, pretty_name, future))
+
+        for app, pretty_name, future in futures:
+            try:
+                ok, exit_code, seconds, tail = future.result()
+                log_jvm_time(appstate, f"Building {pretty_name}", seconds, exit_code)
+            except Exception as e:
+                ok, tail = False, [str(e)]
+            if ok:
+                # The keystore is created by the first build, so the inputs are hashed again
+                appstate["built_apps"][app] = fingerprint(
+                    app, build_config, included_patches, excluded_patches, flag
+                )
+                if app in appstate["patch_sets"]:
+                    appstate["patch_sets"][app]["inputs"] = fingerprint(
+                        app,
+                        build_config,
+                        included_patches,
+                        excluded_patches,
+                        flag,
+                        with_patches=False,
+                    )
+                complete_build(
+                    appstate, app, appstate["built_apps"][app], appstate["patch_sets"].get(app)
+                )
+            else:
+                failed.append((pretty_name, tail))
+
+    if failed:
+        msg = f"There was an error while building {', '.join(name for name, _ in failed)}!"
+        budget = TAIL_MAX_LENGTH // len(failed)
+        for pretty_name, tail in failed:
+            tail = last_lines(tail, budget)
+            if tail:
+                msg += f"\nLast lines of the output for {pretty_name}:\n" + "\n".join(tail)
+        err_exit(msg, appstate)
+
+
+# The last lines of the output that fit in the given number of characters
+def last_lines(tail, length) -> list[str]:
+    res = []
+    for line in reversed(tail):
+        length -= len(line) + 1
+        if length < 0:
+            break
+        res.append(line)
+    return res[::-1]
+
+
+# Decide whether an app has to be rebuilt after a new patches release, under the configured policy
+# Returns the decision and the reason for it
+def patch_impact(appstate, app, record, previous) -> tuple[bool, str]:
+    build_config = appstate["build_config"]
+    policy = build_config.get("patches_diff", "policy", fallback="rebuild")
+    max_defer = build_config.getfloat("patches_diff", "max_defer_days", fallback=7)
+    if policy not in ["rebuild", "skip", "defer"]:
+        err_exit(f"Unknown policy {policy} in the patches_diff section of build_config!", appstate)
+
+    if not previous:
+        return True, "since there's no record of its previous build"
+    if not record["inputs"] or record["inputs"] != previous["inputs"]:
+        return True, "since its apk, the tools or the options changed"
+    diff = diff_patch_sets(previous["patches"], record["patches"])
+    if diff:
+        return True, f"since its patches changed ({diff})"
+
+    if policy == "rebuild":
+        return True, "even though its patches didn't change"
+    if policy == "defer":
+        days = (time.time() - previous["time"]) / 86400
+        if days >= max_defer:
+            return True, f"since it was last built {days:.0f} days ago, and can't be deferred"
+        # Keep checking in the next runs, until the deferral runs out
+        appstate["deferred"].append(app)
+        return False, f"since its patches didn't change, it's deferred for up to {max_defer:g} days"
+    return False, "since its patches didn't change"
+
+
+# Hash of all the inputs of a build, None if some of them are missing
+def fingerprint(
+    app, build_config, included_patches, excluded_patches, flag, with_patches=True
+) -> str | None:
+    try:
+        root = build_config[app].getboolean("root")
+    except cp.Error:
+        root = False
+    keystore = build_config[app].get("keystore")
+    # The keystore is created by revanced-cli during the first build
+    has_keystore = keystore and os.path.isfile(keystore)
+
+    try:
+        inputs = {
+            "apk": file_hash(build_config[app]["apk"] + ".apk"),
+            "patches": file_hash("revanced-patches.rvp") if with_patches else None,
+            "cli": file_hash("revanced-cli.jar"),
+            "included": included_patches,
+            "excluded": excluded_patches,
+            "root": bool(root),
+            "keystore": [keystore, file_hash(keystore) if has_keystore else None],
+            "experimental": flag == "experimental",
+        }
+    except (OSError, KeyError):
+        return None
+
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Construct the revanced-cli command for a build_config section, with the heap size in MiB
+def build_command(
+    app, build_config, included_patches, excluded_patches, flag, appstate, heap=None
+) -> tuple:
+    cmd = " ".join(java_cmd(heap)) + " patch -p revanced-patches.rvp"
+    cmd += " -k revanced-keys.gpg -s revanced-patches.rvp.asc -a revanced-patches.rvp.sigstore.json -r revanced/revanced-patches"
+
+    try:
+        root = build_config[app].getboolean("root")
+    except cp.Error:
+        root = False
+
+    if root:
+        cmd += ' --mount -e "GmsCore support"'
+
+    for item in included_patches:
+        cmd += f" -i {item}"
+    for item in excluded_patches:
+        cmd += f" -e {item}"
+
+    if flag == "experimental":
+        cmd += " --experimental"
+
+    try:
+        keystore = build_config[app]["keystore"]
+        if not root:
+            cmd += f" --keystore {keystore} --keystore-entry-alias=alias --keystore-entry-password=ReVanced --keystore-password=ReVanced"
+    except KeyError:
+        pass
+
+    try:
+        apk = build_config[app]["apk"]
+        pretty_name = build_config[app]["pretty_name"]
+        output_name = build_config[app]["output_name"]
+    except KeyError:
+        err_exit(f"Invalid config for {app} in build_config!", appstate)
+
+    cmd += f" -o {output_name}.apk {apk}.apk"
+    pretty_name += " (root)" if root else " (nonroot)"
+
+    return cmd, pretty_name, output_name
+
+
+# Figure out the number of parallel builds and the heap size (in MiB) for each one
+def parallel_limits(build_config, count) -> tuple[int, int]:
+    if not build_config.getboolean("parallel_build", "enabled", fallback=False):
+        return 1, 0
+
+    cpus = build_config.getint("parallel_build", "cpus", fallback=os.cpu_count() or 1)
+    heap_budget = build_config.getint("parallel_build", "heap_budget", fallback=4096)
+    heap = build_config.getint("parallel_build", "heap_per_build", fallback=1024)
+
+    jobs = min(cpus, heap_budget // heap, count)
+    return max(jobs, 1), heap
+
+
+# Run a single build, returns whether the output apk was produced, the exit code, the time taken
+# and the last lines of the output
+def run_build(cmd, log_file, output_name, pretty_name, print) -> tuple[bool, int, float, list]:
+    # Remove stale output, so that a failed build can't be mistaken for a successful one
+    try:
+        os.remove(output_name + ".apk")
+    except FileNotFoundError:
+        pass
+
+    tail = deque(maxlen=TAIL_LINES)
+    start = time.perf_counter()
+    with (
+        open(log_file, "w") as log,
+        subprocess.Popen(
+            cmd,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        ) as proc,
+    ):
+        assert proc.stdout is not None
+        for line in proc.stdout:
+            log.write(line)
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            tail.append(line[:TAIL_LINE_LENGTH])
+            if SUMMARY_LINE.search(line):
+                print(f"  [{pretty_name}] {line}")
+    seconds = time.perf_counter() - start
 
-        # Build the command to be run
-        cmd = "java -jar revanced-cli.jar patch -p revanced-patches.rvp"
-        cmd += " -k revanced-keys.gpg -s revanced-patches.rvp.asc -a revanced-patches.rvp.sigstore.json -r revanced/revanced-patches"
-
-        try:
-            root = build_config[app].getboolean("root")
-        except cp.Error:
-            root = False
-
-        if root:
-            cmd += ' --mount -e "GmsCore support"'
-
-        for item in included_patches:
-            cmd += f" -i {item}"
-        for item in excluded_patches:
-            cmd += f" -e {item}"
-
-        if flag == "experimental":
-            cmd += " --experimental"
-
-        try:
-            keystore = build_config[app]["keystore"]
-            if not root:
-                cmd += f" --keystore {keystore} --keystore-entry-alias=alias --keystore-entry-password=ReVanced --keystore-password=ReVanced"
-        except KeyError:
-            pass
-
-        try:
-            apk = build_config[app]["apk"]
-            pretty_name = build_config[app]["pretty_name"]
-            output_name = build_config[app]["output_name"]
-        except KeyError:
-            err_exit(f"Invalid config for {app} in build_config!", appstate)
-
-        cmd += f" -o {output_name}.apk {apk}.apk"
-
-        if root:
-            print(f"Building {pretty_name} (root) using '{cmd}'")
-        else:
-            print(f"Building {pretty_name} (nonroot) using '{cmd}'")
-
-        try:
-            with subprocess.Popen(
-                cmd, shell=True, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-            ) as proc:
-                assert proc.stdout is not None
-                for line in proc.stdout:
-                    line_utf = line.decode("utf-8").strip("\n")
-                    if line_utf:
-                        print(line_utf)
-        except Exception as e:
-            err_exit(f"There was an error while building {pretty_name}!\n{e}", appstate)
-
-        try:
-            os.rename(output_name + ".apk", output_name + ".apk")
-        except FileNotFoundError:
-            err_exit(f"There was an error while building {pretty_name}!", appstate)
+    ok = proc.returncode == 0 and os.path.isfile(output_name + ".apk")
+    return ok, proc.returncode, seconds, list(tail)
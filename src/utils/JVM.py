@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+import json
+import os
+import subprocess
+import time
+
+from utils.Checkpoint import write_json
+from utils.Metrics import record
+
+CDS_ARCHIVE = "revanced-cli.jsa"
+CDS_INFO = "revanced-cli.jsa.json"
+
+# Keep JVM warnings (e.g. about a stale archive) out of stdout, since we parse it
+JVM_LOG_OPTS = ["-Xlog:disable", "-Xlog:all=warning:stderr"]
+
+
+# Command prefix for running revanced-cli, using the class data sharing archive if present
+# The maximum heap size is in MiB, the JVM's default is used without it
+def java_cmd(heap=None) -> list[str]:
+    cmd = ["java"] + JVM_LOG_OPTS
+    if heap:
+        cmd += [f"-Xmx{heap}m"]
+    if os.path.isfile(CDS_ARCHIVE):
+        cmd += ["-Xshare:auto", f"-XX:SharedArchiveFile={CDS_ARCHIVE}"]
+    return cmd + ["-jar", "revanced-cli.jar"]
+
+
+# Time a trivial invocation of revanced-cli, which is dominated by JVM startup
+def startup_time(cmd) -> float:
+    start = time.perf_counter()
+    subprocess.run(cmd + ["--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+# (Re)create the CDS archive for the current revanced-cli.jar
+def update_cds_archive(appstate, cli_updated) -> None:
+    print = appstate["logger"].info
+
+    if not os.path.isfile("revanced-cli.jar"):
+        return
+    if not cli_updated and os.path.isfile(CDS_ARCHIVE):
+        return
+
+    print("Creating class data sharing archive for revanced-cli...")
+    for file in [CDS_ARCHIVE, CDS_INFO]:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+    # Use a real workload, so that the classes needed for parsing patches get archived as well
+    train_cmd = ["java"] + JVM_LOG_OPTS + [f"-XX:ArchiveClassesAtExit={CDS_ARCHIVE}"]
+    train_cmd += ["-jar", "revanced-cli.jar", "list-patches", "--packages", "--versions"]
+    if os.path.isfile("revanced-patches.rvp"):
+        train_cmd += ["-bp", "revanced-patches.rvp"]
+    try:
+        subprocess.run(train_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        print(f"Could not create the archive, continuing without it: {ex}")
+        return
+
+    if not os.path.isfile(CDS_ARCHIVE):
+        print("The JVM did not create the archive, continuing without it.")
+        return
+
+    without_cds = startup_time(["java"] + JVM_LOG_OPTS + ["-jar", "revanced-cli.jar"])
+    with_cds = startup_time(java_cmd())
+    write_json(
+        CDS_INFO, {"startup_without_cds": without_cds, "startup_with_cds": with_cds}, indent=4
+    )
+    print(f"JVM startup takes {with_cds:.2f}s with the archive, {without_cds:.2f}s without it.")
+
+
+# Estimated JVM startup time saved per invocation by the archive
+def cds_saving() -> float:
+    if not os.path.isfile(CDS_ARCHIVE):
+        return 0.0
+    try:
+        with open(CDS_INFO, "r") as f:
+            info = json.load(f)
+        return max(info["startup_without_cds"] - info["startup_with_cds"], 0.0)
+    except (OSError, ValueError, KeyError):
+        return 0.0
+
+
+def log_jvm_time(appstate, what, seconds, exit_code=0) -> None:
+    print = appstate["logger"].info
+
+    msg = f"{what} took {seconds:.1f}s"
+    saving = cds_saving()
+    if saving:
+        msg += f" (class data sharing saved about {saving:.2f}s of JVM startup)"
+    print(msg)
+    record(appstate, "jvm", seconds, task=what, exit_code=exit_code, cds_saving=saving)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+metrics_lock = threading.Lock()
+
+
+# Record a finished span, in memory and as a line in logs/<timestamp>.jsonl
+def record(appstate, name, duration, **fields) -> None:
+    entry = {"name": name, "start": time.time() - duration, "duration": duration, **fields}
+    with metrics_lock:
+        appstate.setdefault("metrics", []).append(entry)
+        try:
+            with open(f"logs/{appstate['timestamp']}.jsonl", "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        except (OSError, KeyError):
+            pass
+
+
+# Time a block of code, extra fields can be added to the yielded dict
+@contextmanager
+def span(appstate, name, **fields):
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as ex:
+        fields.setdefault("error", repr(ex))
+        raise
+    finally:
+        record(appstate, name, time.perf_counter() - start, **fields)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Write the metrics of this run for the textfile collector of node_exporter, if configured
+def export_prometheus(appstate, success) -> None:
+    try:
+        path = appstate["build_config"].get("metrics", "prometheus_textfile", fallback=None)
+    except KeyError:
+        path = None
+    if not path:
+        return
+
+    lines = [
+        "# HELP revanced_builder_last_run_timestamp_seconds Time at which the last run finished.",
+        "# TYPE revanced_builder_last_run_timestamp_seconds gauge",
+        f"revanced_builder_last_run_timestamp_seconds {time.time():.3f}",
+        "# HELP revanced_builder_last_run_success Whether the last run finished without errors.",
+        "# TYPE revanced_builder_last_run_success gauge",
+        f"revanced_builder_last_run_success {int(success)}",
+    ]
+    gauges = {
+        "revanced_builder_phase_seconds": ("Time spent in each phase.", []),
+        "revanced_builder_jvm_seconds": ("Wall time of each revanced-cli invocation.", []),
+        "revanced_builder_download_bytes_per_second": ("Throughput of each download.", []),
+    }
+    for entry in appstate.get("metrics", []):
+        if entry.get("phase"):
+            samples = gauges["revanced_builder_phase_seconds"][1]
+            samples.append((f'phase="{escape(entry["name"])}"', entry["duration"]))
+        elif entry["name"] == "jvm":
+            samples = gauges["revanced_builder_jvm_seconds"][1]
+            samples.append((f'task="{escape(entry["task"])}"', entry["duration"]))
+        elif entry["name"] == "download" and "bytes_per_sec" in entry:
+            samples = gauges["revanced_builder_download_bytes_per_second"][1]
+            samples.append((f'file="{escape(entry["file"])}"', entry["bytes_per_sec"]))
+
+    for metric, (description, samples) in gauges.items():
+        if samples:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+            lines += [f"{metric}{{{labels}}} {value:.3f}" for labels, value in samples]
+
+    # The collector may read the file at any time, so it has to be replaced atomically
+    try:
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+    except OSError as ex:
+        appstate["logger"].info(f"Could not write the Prometheus metrics to {path}: {ex}")
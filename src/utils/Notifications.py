@@ -4,11 +4,23 @@
 # SPDX-License-Identifier: GPL-3.0-only
 
 import json
+import os
 import re
-import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests as req
 
+from utils.Checkpoint import write_json
+
+QUEUE_FILE = "notification-queue.json"
+# Undelivered notifications are retried for a week, and at most this many are kept
+QUEUE_MAX_AGE = 7 * 86400
+QUEUE_MAX_SIZE = 100
+DEFAULT_TIMEOUT = 10
+# Longest message accepted by the Telegram Bot API
+TELEGRAM_MAX_LENGTH = 4096
+
 
 def send_notif(appstate, msg="", error=False) -> None:
     print = appstate["logger"].info
@@ -34,72 +46,139 @@ def send_notif(appstate, msg="", error=False) -> None:
                 continue
             msg = msg.replace(build_config[app]["apk"], build_config[app]["pretty_name"])
 
-        msg += "\nTimestamp: " + timestamp
+        # The timestamp of the archived builds, which differs from this run's when it's resumed
+        msg += "\nTimestamp: " + appstate.get("build_timestamp", timestamp)
         if appstate["gmscore_updated"]:
             msg += "\nGmsCore was updated."
 
+    deliveries = [(entry, msg) for entry in enabled_backends(appstate)]
+    failed = deliver(appstate, deliveries)
+    if failed:
+        save_queue(load_queue() + failed)
+
+
+def enabled_backends(appstate) -> list[str]:
     config = appstate["notification_config"]
-    for entry in config:
-        if not config[entry].getboolean("enabled"):
-            continue
-        encoded_title = "⚙⚙⚙ ReVanced Build ⚙⚙⚙".encode("utf-8")
+    return [entry for entry in config if config[entry].getboolean("enabled")]
 
-        if entry == "ntfy":
-            print("Sending notification through ntfy.sh...")
-            try:
-                url = config[entry]["url"]
-                topic = config[entry]["topic"]
-            except KeyError:
-                print("URL or TOPIC not provided!")
-                continue
-            headers = {
-                "Icon": "https://upload.wikimedia.org/wikipedia/commons/thumb/4/40/Revanced-logo-round.svg/240px-Revanced-logo-round.svg.png",
-                "Title": encoded_title,
-            }
-            try:
-                token = config[entry]["token"]
-                headers["Authorization"] = "Bearer " + token
-            except KeyError:
-                continue
-            try:
-                req.post(f"{url}/{topic}", msg, headers=headers)
-            except Exception as ex:
-                print(f"Failed with exception: {ex}")
 
-        elif entry == "gotify":
-            print("Sending notification through Gotify...")
-            try:
-                url = config[entry]["url"]
-                token = config[entry]["token"]
-            except KeyError:
-                print("URL or TOKEN not provided!")
-                continue
-            data = {"Title": encoded_title, "message": msg, "priority": "5"}
-            try:
-                req.post(f"{url}/message?token={token}", data)
-            except Exception as e:
-                print("Failed!" + str(e))
+# Build the request for sending a message through a backend, or None if it's not configured
+def build_request(appstate, entry, msg) -> tuple[str, dict] | None:
+    print = appstate["logger"].info
+    config = appstate["notification_config"]
+    encoded_title = "⚙⚙⚙ ReVanced Build ⚙⚙⚙".encode("utf-8")
 
-        elif entry == "telegram":
-            print("Sending notification through Telegram...")
-            try:
-                chat = config[entry]["chat"]
-                token = config[entry]["token"]
-            except KeyError:
-                print("CHAT or TOKEN not provided!")
+    if entry == "ntfy":
+        try:
+            url = config[entry]["url"]
+            topic = config[entry]["topic"]
+        except KeyError:
+            print("URL or TOPIC not provided!")
+            return None
+        headers = {
+            "Icon": "https://upload.wikimedia.org/wikipedia/commons/thumb/4/40/Revanced-logo-round.svg/240px-Revanced-logo-round.svg.png",
+            "Title": encoded_title,
+        }
+        try:
+            token = config[entry]["token"]
+            headers["Authorization"] = "Bearer " + token
+        except KeyError:
+            pass
+        return f"{url}/{topic}", {"data": msg.encode("utf-8"), "headers": headers}
+
+    elif entry == "gotify":
+        try:
+            url = config[entry]["url"]
+            token = config[entry]["token"]
+        except KeyError:
+            print("URL or TOKEN not provided!")
+            return None
+        data = {"Title": encoded_title, "message": msg, "priority": "5"}
+        return f"{url}/message?token={token}", {"data": data}
+
+    elif entry == "telegram":
+        try:
+            chat = config[entry]["chat"]
+            token = config[entry]["token"]
+        except KeyError:
+            print("CHAT or TOKEN not provided!")
+            return None
+        text = f"{encoded_title.decode('utf-8')}\n{msg}"
+        data = {"chat_id": chat, "text": text[:TELEGRAM_MAX_LENGTH]}
+        return f"https://api.telegram.org/bot{token}/sendMessage", {"data": data}
+
+    print("Don't know how to send notifications to " + entry)
+    return None
+
+
+# Send the messages through all the backends at once, returns the ones that failed
+def deliver(appstate, deliveries) -> list[dict]:
+    print = appstate["logger"].info
+    config = appstate["notification_config"]
+    session = appstate.get("session", req)
+    names = {"ntfy": "ntfy.sh", "gotify": "Gotify", "telegram": "Telegram"}
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(len(deliveries), 1)) as pool:
+        futures = []
+        for entry, msg in deliveries:
+            request = build_request(appstate, entry, msg)
+            if not request:
                 continue
-            cmd = f'./telegram.sh -t {token} -c {chat} -T {encoded_title} -M "{msg}"'
+            url, kwargs = request
+            timeout = config.getfloat(entry, "timeout", fallback=DEFAULT_TIMEOUT)
+            print(f"Sending notification through {names.get(entry, entry)}...")
+            futures.append((entry, msg, pool.submit(session.post, url, timeout=timeout, **kwargs)))
+
+        for entry, msg, future in futures:
             try:
-                with subprocess.Popen(
-                    cmd, shell=True, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-                ) as proc:
-                    assert proc.stdout is not None
-                    for line in proc.stdout:
-                        line_utf = line.decode("utf-8").strip("\n")
-                        if line_utf:
-                            print(line_utf)
+                future.result().raise_for_status()
             except Exception as ex:
-                print(f"Failed to send notification with exception: {ex}")
+                print(f"Failed to send notification through {names.get(entry, entry)}: {ex}")
+                # A rejected message would be rejected again, only rate limiting is temporary
+                status = getattr(getattr(ex, "response", None), "status_code", None)
+                if status and 400 <= status < 500 and status != 429:
+                    continue
+                failed.append({"backend": entry, "message": msg, "time": time.time()})
+
+    return failed
+
+
+def load_queue() -> list[dict]:
+    try:
+        with open(QUEUE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+# Only the backend and the message are stored, the rest comes from the config when retrying
+def save_queue(queue) -> None:
+    queue = [item for item in queue if item["time"] > time.time() - QUEUE_MAX_AGE]
+    queue = queue[-QUEUE_MAX_SIZE:]
+    if not queue:
+        try:
+            os.remove(QUEUE_FILE)
+        except FileNotFoundError:
+            pass
+        return
+    write_json(QUEUE_FILE, queue, indent=4)
+
+
+# Retry the notifications that couldn't be delivered earlier
+def flush_queue(appstate) -> None:
+    queue = load_queue()
+    if not queue:
+        return
 
-        else:
-            print("Don't know how to send notifications to " + entry)
+    appstate["logger"].info(f"Retrying {len(queue)} undelivered notification(s)...")
+    backends = enabled_backends(appstate)
+    deliveries = [
+        (item["backend"], item["message"]) for item in queue if item["backend"] in backends
+    ]
+    failed = deliver(appstate, deliveries)
+    # Failed retries keep their original time, so that they expire eventually
+    times = {(item["backend"], item["message"]): item["time"] for item in queue}
+    for item in failed:
+        item["time"] = times.get((item["backend"], item["message"]), item["time"])
+    save_queue(failed)
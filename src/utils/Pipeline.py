@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Sayantan Santra <sayantan.santra689@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-only
+
+import configparser as cp
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests as req
+from packaging.version import Version
+
+from utils.APKPure_dl import get_apks
+from utils.ArtifactStore import blob_path, fetch, link_blob, store_path
+from utils.Checkpoint import (
+    check_tools,
+    clear_checkpoint,
+    complete,
+    failed_post_script,
+    load_checkpoint,
+    pending,
+    pending_build,
+    write_json,
+)
+from utils.Cleanup import cleanup_logs, err_exit, move_apps, send_notif
+from utils.Downloader import chunk_size, download, file_hash
+from utils.HTTPCache import cached_get
+from utils.JAVABuilder import build_apps
+from utils.JVM import update_cds_archive
+from utils.Metrics import export_prometheus, span
+from utils.Notifications import flush_queue
+
+SIGNATURE_CACHE = "signatures"
+SIGNATURE_FILES = [
+    "revanced-patches.rvp.asc",
+    "revanced-keys.gpg",
+    "revanced-patches.rvp.sigstore.json",
+]
+
+
+def update_signatures(appstate) -> None:
+    session = appstate["session"]
+    bundle_hash = file_hash("revanced-patches.rvp")
+    cache_dir = os.path.abspath(os.path.join(SIGNATURE_CACHE, bundle_hash))
+
+    # The signatures only change along with the patches, so they're fetched once per bundle
+    # In multi-profile mode, they may come from the cache of the previous profile
+    shared = appstate.get("shared", {}).setdefault("signatures", {})
+    source = shared.get(bundle_hash, cache_dir)
+    if all(os.path.isfile(os.path.join(source, file)) for file in SIGNATURE_FILES):
+        print("Using cached signatures for revanced patches.")
+        store_signatures(appstate, source, bundle_hash)
+        for file in SIGNATURE_FILES:
+            link_blob(os.path.join(cache_dir, file), file)
+        shared[bundle_hash] = cache_dir
+        return
+
+    try:
+        data = json.loads(cached_get("https://api.revanced.app/v5/patches", session))
+    except (req.exceptions.RequestException, ValueError) as e:
+        err_exit(f"Error fetching information about revanced-patches signature, {e}", appstate)
+    url = data["signature_download_url"]
+
+    output_file = "revanced-patches.rvp.asc"
+    print("Updating signature for revanced patches.")
+    try:
+        download(url, output_file, session, chunk_size(appstate))
+    except req.exceptions.RequestException as e:
+        err_exit(f"Error downloading revanced-patches signature, {e}", appstate)
+
+    print("Updating the GPG signature.")
+    data = json.loads(cached_get("https://api.revanced.app/v5/patches/keys", session))
+    key = data["patches_public_key"]
+    # These files may be hardlinked into other profiles, so they're replaced instead of rewritten
+    with open("revanced-keys.gpg.tmp", "w") as f:
+        f.write(key)
+    os.replace("revanced-keys.gpg.tmp", "revanced-keys.gpg")
+
+    print("Updating the attestations.")
+    url = "https://api.github.com/repos/revanced/revanced-patches/attestations"
+    try:
+        res = session.get(f"{url}/sha256:{bundle_hash}")
+        res.raise_for_status()
+        bundle = res.json()["attestations"][0]["bundle"]
+    except (req.RequestException, KeyError, IndexError, ValueError) as e:
+        err_exit(f"Error fetching the attestations of revanced-patches, {e}", appstate)
+    write_json("revanced-patches.rvp.sigstore.json", bundle)
+
+    store_signatures(appstate, os.getcwd(), bundle_hash)
+    shared[bundle_hash] = cache_dir
+    print("Done!")
+
+
+# Put the signatures of a bundle in the cache, and remove the ones of bundles that are gone
+def store_signatures(appstate, source, bundle_hash) -> None:
+    cache_dir = os.path.abspath(os.path.join(SIGNATURE_CACHE, bundle_hash))
+    if source != cache_dir:
+        shutil.rmtree(cache_dir + ".tmp", ignore_errors=True)
+        os.makedirs(cache_dir + ".tmp")
+        for file in SIGNATURE_FILES:
+            link_blob(os.path.join(source, file), os.path.join(cache_dir + ".tmp", file))
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(cache_dir + ".tmp", cache_dir)
+
+    # Signatures are kept as long as their bundle is in use, or in the artifact store
+    store = store_path(appstate)
+    with os.scandir(SIGNATURE_CACHE) as dir:
+        for entry in dir:
+            if entry.name == bundle_hash:
+                continue
+            if store and os.path.isfile(blob_path(store, entry.name)):
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# Fetch the latest release information for a tool from GitHub
+def fetch_tool_info(item, session) -> dict:
+    url = f"https://api.github.com/repos/revanced/{item}/releases/latest"
+    data = json.loads(cached_get(url, session))
+    if "assets" not in data:
+        raise req.RequestException(f"unexpected response from GitHub, {data.get('message')}")
+
+    assets = filter(
+        lambda a: not a["browser_download_url"].endswith((".asc", "-hw-signed.apk")),
+        data["assets"],
+    )
+    url = next(assets)["browser_download_url"]
+
+    return {
+        "version": data["tag_name"],
+        "browser_download_url": url,
+    }
+
+
+# Update the ReVanced tools, if needed
+def update_tools(appstate) -> dict:
+    print = appstate["logger"].info
+    session = appstate["session"]
+    items = ["revanced-cli", "revanced-patches", "GmsCore"]
+    workers = appstate["build_config"].getint("downloads", "concurrency", fallback=3)
+
+    # In multi-profile mode, the releases are only looked up for the first profile
+    shared = appstate.get("shared", {})
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # Query all the release endpoints at once
+        if "tools" not in shared:
+            futures = {item: pool.submit(fetch_tool_info, item, session) for item in items}
+            tools = {}
+            for item in items:
+                try:
+                    tools[item] = futures[item].result()
+                except (req.RequestException, KeyError, ValueError) as e:
+                    # Don't start the remaining requests only to wait for them on the way out
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    err_exit(f"Error fetching information about {item}, {e}", appstate)
+            shared["tools"] = tools
+        tools = shared["tools"]
+
+        downloads = {}
+        for item in tools.keys():
+            print(f"Checking updates for {item}...")
+            tool = tools[item]
+            latest_ver = Version(tool["version"])
+
+            try:
+                present_ver = Version(appstate["present_vers"][item])
+            except KeyError:
+                present_ver = Version("0")
+
+            extension = tool["browser_download_url"].rsplit(".", 1)[-1]
+            output_file = f"{item}.{extension}"
+            flag = appstate["flag"]
+            if flag == "force" or not os.path.isfile(output_file) or present_ver < latest_ver:
+                appstate["up-to-date"] = False
+                print(f"{item} has an update ({str(present_ver)} -> {str(latest_ver)})")
+                if flag != "checkonly":
+                    print(f"Downloading {output_file}...")
+                    downloads[item] = pool.submit(
+                        fetch, tool["browser_download_url"], output_file, appstate, session
+                    )
+
+        # Wait for the downloads in the original order, so that versions are recorded the same way
+        for item, future in downloads.items():
+            try:
+                future.result()
+            except req.RequestException as e:
+                pool.shutdown(wait=False, cancel_futures=True)
+                err_exit(f"Error downloading {item}, {e}", appstate)
+            appstate["present_vers"].update({item: str(Version(tools[item]["version"]))})
+            print(f"Downloaded {item}.")
+
+    if appstate["flag"] != "checkonly":
+        update_cds_archive(appstate, "revanced-cli" in downloads)
+
+    appstate["tools"] = tools
+    return appstate
+
+
+# The versions and hashes of the tools, which a checkpoint is only valid for
+def tool_state(appstate) -> dict:
+    state = {
+        item: appstate["present_vers"].get(item)
+        for item in ["revanced-cli", "revanced-patches", "GmsCore"]
+    }
+    for file in ["revanced-cli.jar", "revanced-patches.rvp"]:
+        state[file] = file_hash(file) if os.path.isfile(file) else None
+    return state
+
+
+def sync_json(appstate, need_to_build):
+    appstate["present_vers"]["need_to_build"] = need_to_build
+    write_json("versions.json", appstate["present_vers"], indent=4)
+
+
+# Delete the lockfile, unless err_exit already did
+def release_lock() -> None:
+    try:
+        os.remove("lockfile")
+    except FileNotFoundError:
+        pass
+
+
+# Try to make sure only one instance is running in a given working directory
+def acquire_lock() -> bool:
+    try:
+        if os.path.exists("lockfile"):
+            raise FileExistsError
+        with open("tmplockfile", "x") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace("tmplockfile", "lockfile")
+    except FileExistsError:
+        return False
+    return True
+
+
+# Get a new timestamp, and send the logs to a new file named after it
+def start_log(appstate) -> datetime:
+    time = datetime.now()
+    appstate["timestamp"] = time.strftime("%Y-%m-%dT%H-%M-%SZ")
+
+    logger = appstate["logger"]
+    if "log_handler" in appstate:
+        logger.removeHandler(appstate["log_handler"])
+        appstate["log_handler"].close()
+    appstate["log_handler"] = logging.FileHandler(f"logs/{appstate['timestamp']}.log", "w")
+    logger.addHandler(appstate["log_handler"])
+
+    return time
+
+
+def read_configs(appstate) -> None:
+    try:
+        appstate["build_config"] = cp.ConfigParser()
+        appstate["build_config"].read_file(open("build_config", "r"))
+    except FileNotFoundError:
+        err_exit(
+            "No build config provided, exiting. Please look at the GitHub page for more information:\n  https://github.com/SinTan1729/ReVancedBuilder",
+            appstate,
+        )
+
+    appstate["notification_config"] = cp.ConfigParser()
+    appstate["notification_config"].read("notification_config")
+
+
+def read_versions() -> dict:
+    try:
+        with open("versions.json", "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        # We'll treat empty as 0 later
+        return {}
+
+
+# Check whether any of the tools has a new release, without downloading anything
+def upstream_changed(appstate) -> bool:
+    present_vers = read_versions()
+    if pending_build(present_vers):
+        return True
+
+    items = ["revanced-cli", "revanced-patches", "GmsCore"]
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        infos = pool.map(lambda item: fetch_tool_info(item, appstate["session"]), items)
+        for item, info in zip(items, infos):
+            present_ver = Version(present_vers.get(item, "0"))
+            if present_ver < Version(info["version"]):
+                return True
+    return False
+
+
+# Run the pipeline once
+def run(appstate, time) -> None:
+    print = appstate["logger"].info
+    flag = appstate["flag"]
+
+    print(f"Started building ReVanced apps at {time.strftime('%d %B, %Y %H:%M:%S')}")
+    print("----------------------------------------------------------------------")
+
+    # Read configs
+    read_configs(appstate)
+    flush_queue(appstate)
+
+    # Read current local versions
+    appstate["present_vers"] = read_versions()
+    appstate["gmscore_updated"] = False
+    appstate["up-to-date"] = True
+    appstate["metrics"] = []
+    appstate["deferred"] = []
+
+    # An interrupted run is resumed from its first incomplete stage
+    checkpoint = load_checkpoint(appstate)
+    need_to_build = appstate["present_vers"].get("need_to_build", False) or bool(checkpoint["done"])
+    if flag != "buildonly":
+        # The tools are always checked, so that a new release isn't missed while resuming
+        with span(appstate, "update_tools", phase=True):
+            appstate = update_tools(appstate)
+        if not appstate["up-to-date"] and flag != "checkonly":
+            try:
+                os.rename("versions.json", "versions-old.json")
+            except FileNotFoundError:
+                pass
+            sync_json(appstate, True)
+        checkpoint = check_tools(appstate, tool_state(appstate))
+        if (not appstate["up-to-date"] and flag != "checkonly") or flag == "force" or need_to_build:
+            if pending(appstate, "apks"):
+                with span(appstate, "get_apks", phase=True):
+                    appstate = get_apks(appstate)
+                sync_json(appstate, True)
+                complete(appstate, "apks")
+            if pending(appstate, "signatures"):
+                with span(appstate, "update_signatures", phase=True):
+                    update_signatures(appstate)
+                complete(appstate, "signatures")
+
+    if (
+        (flag != "checkonly" and not appstate["up-to-date"])
+        or flag in ["force", "buildonly"]
+        or need_to_build
+    ):
+        # Every finished build is recorded by build_apps, so only the missing ones are built
+        if pending(appstate, "build"):
+            with span(appstate, "build_apps", phase=True):
+                build_apps(appstate)
+            complete(appstate, "build")
+        else:
+            appstate["built_apps"] = {
+                app: built["fingerprint"] for app, built in checkpoint["built"].items()
+            }
+            appstate["patch_sets"] = {
+                app: built["patch_set"]
+                for app, built in checkpoint["built"].items()
+                if built.get("patch_set")
+            }
+        if pending(appstate, "archive"):
+            with span(appstate, "move_apps", phase=True):
+                move_apps(appstate)
+            # The archived files are named after it, so later stages are resumed with it
+            checkpoint["timestamp"] = appstate["timestamp"]
+            complete(appstate, "archive")
+    appstate["build_timestamp"] = checkpoint.get("timestamp", appstate["timestamp"])
+
+    # Update version numbers in the versions.json file
+    post_script_failed = False
+    if appstate["up-to-date"] and flag != "buildonly" and (not need_to_build):
+        print("There's nothing to do.")
+    elif flag != "checkonly" and appstate["deferred"] and not appstate["built_apps"]:
+        # Only deferred builds were checked, so there's nothing new to report
+        print("All the builds are deferred, there's nothing to do yet.")
+        sync_json(appstate, True)
+    elif flag != "checkonly":
+        # Deferred builds are checked again in the next run
+        sync_json(appstate, bool(appstate["deferred"]))
+        if flag != "buildonly" and pending(appstate, "post_script"):
+            try:
+                script = appstate["build_config"]["post_script"]["file"]
+                cmd = f"{script} {appstate['build_timestamp']}"
+                print(f"Running the post command '{cmd}'")
+                with span(appstate, "post_script", phase=True) as fields:
+                    fields["exit_code"] = subprocess.run(cmd, shell=True).returncode
+            except Exception as ex:
+                print(f"Got exception while running the post-command: '{ex}'")
+                clear_checkpoint(appstate)
+                err_exit("", appstate, 0)
+            if fields["exit_code"] == 0:
+                complete(appstate, "post_script")
+            elif failed_post_script(appstate):
+                print(f"The post command failed with exit code {fields['exit_code']}.")
+                print("It will be run again in the next run.")
+                post_script_failed = True
+            else:
+                print(f"The post command failed with exit code {fields['exit_code']}.")
+                print("It failed too many times, giving up on it.")
+                complete(appstate, "post_script")
+
+        if pending(appstate, "notify"):
+            with span(appstate, "send_notif", phase=True):
+                send_notif(appstate)
+            complete(appstate, "notify")
+
+    if not post_script_failed:
+        clear_checkpoint(appstate)
+    cleanup_logs(appstate)
+    export_prometheus(appstate, True)
+
+
+# Run the pipeline for several working directories (profiles) one after another
+# The tools, signatures, patches and downloads are shared, everything else is per profile
+def multi(appstate, dirs) -> int:
+    appstate["shared"] = {}
+    code = 0
+
+    for dir in dirs:
+        os.chdir(dir)
+        if not acquire_lock():
+            appstate["logger"].info(f"Another instance is already running in {dir}, skipping it.")
+            code = 1
+            continue
+        os.makedirs("logs", exist_ok=True)
+
+        try:
+            run(appstate, start_log(appstate))
+        except SystemExit as ex:
+            # err_exit has already reported the error
+            code = max(code, ex.code if isinstance(ex.code, int) else 1)
+        finally:
+            release_lock()
+
+    return code
+
+
+# Stay resident, and run the pipeline whenever there's something new upstream
+def daemon(appstate) -> None:
+    print = appstate["logger"].info
+    stop = threading.Event()
+
+    def shutdown(signum, frame) -> None:
+        print("Shutting down once the current run is finished.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Long waits, e.g. for the rate limit, are cut short by it
+    appstate["stop"] = stop
+
+    failures = 0
+    while not stop.is_set():
+        try:
+            read_configs(appstate)
+            flush_queue(appstate)
+            if upstream_changed(appstate):
+                run(appstate, start_log(appstate))
+            failures = 0
+        except SystemExit as ex:
+            # err_exit has already reported the error and deleted the lockfile
+            # A missing post script also ends up here, with a zero exit code
+            failures = failures + 1 if ex.code else 0
+            if not acquire_lock():
+                sys.exit("Another instance is already running in the same working directory!")
+        except (req.RequestException, KeyError, ValueError) as ex:
+            failures += 1
+            print(f"Could not check for updates: {ex}")
+        except Exception:
+            # Anything else is a bug, but it shouldn't take the daemon down
+            failures += 1
+            appstate["logger"].exception("Unexpected error, trying again later.")
+
+        # Back off exponentially after failures, with some jitter to spread out the requests
+        config = appstate.get("build_config") or cp.ConfigParser()
+        interval = config.getint("daemon", "interval", fallback=3600)
+        max_interval = config.getint("daemon", "max_interval", fallback=86400)
+        jitter = config.getfloat("daemon", "jitter", fallback=0.1)
+        delay = min(interval * 2**failures, max(max_interval, interval))
+        stop.wait(delay * random.uniform(1 - jitter, 1 + jitter))